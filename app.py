@@ -1,27 +1,553 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, Blueprint, Response, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import g, has_app_context, has_request_context, get_template_attribute
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 import psycopg2
+from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
 from werkzeug.security import generate_password_hash, check_password_hash
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+import atexit
+import click
+import csv
+import functools
+import io
+import json
 import os
+import select
+import stat
+import threading
+import time
 
-app = Flask(__name__, 
-           static_folder='static',
-           template_folder='templates')
-app.secret_key = os.environ.get('SECRET_KEY', 'dev_secret_key')
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
+
+# Routes and management commands; registered on the app by create_app()
+bp = Blueprint('main', __name__, cli_group=None)
+
+# Read replicas, e.g. "replica1:5432,replica2:5433"
+def parse_hosts(value, default_port):
+    return [
+        (host.strip().split(':')[0], host.strip().split(':')[1] if ':' in host else default_port)
+        for host in value.split(',') if host.strip()
+    ]
+
+# All settings in one place, read from the environment once at import.
+# Every worker process started from the same environment gets the same
+# configuration, which matters for SECRET_KEY: sessions are signed cookies,
+# so any worker can read a session created by another as long as they share it.
+class Config:
+    # "production" refuses to start with the development SECRET_KEY
+    APP_ENV = os.environ.get('APP_ENV', 'development')
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev_secret_key')
+    
+    # Primary database
+    DB_NAME = os.environ.get('DB_NAME', 'event_booking')
+    DB_USER = os.environ.get('DB_USER', 'postgres')
+    DB_PASSWORD = os.environ.get('DB_PASSWORD', 'postgres')
+    DB_HOST = os.environ.get('DB_HOST', 'localhost')
+    DB_PORT = os.environ.get('DB_PORT', '5432')
+    # Seconds to wait for PostgreSQL before giving up on a connection
+    DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+    # Shown in pg_stat_activity; used to tell whether the app is still serving
+    DB_APPLICATION_NAME = os.environ.get('DB_APPLICATION_NAME', 'event_booking')
+    
+    # Read replicas
+    DB_REPLICAS = parse_hosts(os.environ.get('DB_REPLICA_HOSTS', ''), DB_PORT)
+    # Replicas lagging further behind the primary than this are skipped
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+    # How long a failed or lagging replica is left out of rotation
+    REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', '30'))
+    # A replica's lag check is reused for this long before it is run again
+    REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '5'))
+    # A replica only counts as streaming if it heard from the primary this
+    # recently; an idle primary still sends keepalives every
+    # wal_receiver_timeout / 2 (60s by default)
+    REPLICA_RECEIVER_TIMEOUT_SECONDS = float(os.environ.get('REPLICA_RECEIVER_TIMEOUT_SECONDS', '60'))
+    # After a write, a user's reads go to the primary for this long (read-your-writes)
+    READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+    
+    # Compiled templates are cached on disk so restarts and new workers skip
+    # parsing; blank means a jinja_cache folder in the app's instance folder
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', '')
+    # Rendered row fragments are shared between workers through Redis when
+    # CACHE_URL is set (e.g. redis://localhost:6379/0), otherwise kept per process
+    CACHE_URL = os.environ.get('CACHE_URL', '')
+    # Maximum number of rendered row fragments kept in memory
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', '20000'))
+    # How long a fragment stays in the shared cache (seconds)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', '3600'))
+    
+    # Number of bookings cancelled per transaction when an event is cancelled
+    CANCELLATION_BATCH_SIZE = int(os.environ.get('CANCELLATION_BATCH_SIZE', '500'))
+    # How often each worker looks for interrupted cancellation jobs to pick up (seconds)
+    CANCELLATION_RESUME_SECONDS = float(os.environ.get('CANCELLATION_RESUME_SECONDS', '60'))
+    
+    # How long a promoted waitlist user has to claim their tickets
+    WAITLIST_CLAIM_MINUTES = int(os.environ.get('WAITLIST_CLAIM_MINUTES', '30'))
+    # Waiting entries that haven't been offered tickets by then expire
+    WAITLIST_MAX_WAIT_HOURS = int(os.environ.get('WAITLIST_MAX_WAIT_HOURS', '72'))
+    
+    # Availability changes are pushed to browsers at most this often (seconds)
+    AVAILABILITY_PUSH_INTERVAL = float(os.environ.get('AVAILABILITY_PUSH_INTERVAL', '0.5'))
+    # Idle server-sent event streams get a keep-alive comment this often (seconds)
+    SSE_HEARTBEAT_SECONDS = 15
+    # "auto" serves live updates only where an open stream doesn't tie up a
+    # worker (gevent workers or the threaded development server); "on"/"off" force it
+    LIVE_UPDATES = os.environ.get('LIVE_UPDATES', 'auto')
+    
+    # Audit log rows are written in batches of up to this many rows ...
+    AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', '1000'))
+    # ... or at least this often (seconds)
+    AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', '1'))
+    
+    # Purchase limits used when an event doesn't set its own
+    DEFAULT_MAX_TICKETS_PER_BOOKING = int(os.environ.get('DEFAULT_MAX_TICKETS_PER_BOOKING', '10'))
+    DEFAULT_MAX_TICKETS_PER_USER = int(os.environ.get('DEFAULT_MAX_TICKETS_PER_USER', '20'))
+    # A user may make at most BOOKING_VELOCITY_LIMIT bookings per window
+    BOOKING_VELOCITY_LIMIT = int(os.environ.get('BOOKING_VELOCITY_LIMIT', '5'))
+    BOOKING_VELOCITY_WINDOW_SECONDS = int(os.environ.get('BOOKING_VELOCITY_WINDOW_SECONDS', '60'))
+    
+    # Hours after booking during which it can be cancelled, for events that
+    # don't set their own window
+    DEFAULT_CANCELLATION_WINDOW_HOURS = int(os.environ.get('DEFAULT_CANCELLATION_WINDOW_HOURS', '24'))
+    
+    # Count queries, database time and rows per request (on by default outside production)
+    QUERY_PROFILING = os.environ.get('QUERY_PROFILING', '0' if APP_ENV == 'production' else '1') == '1'
+    # The same statement run this many times in one request is reported as a likely N+1
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '5'))
+    # Raise QueryBudgetExceeded instead of logging when a route goes over budget (for tests)
+    QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', '0') == '1'
+
+# Idempotent DDL applied to databases created before these tables existed
+SCHEMA_UPGRADES = [
+    """
+    ALTER TABLE events ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1
+    """,
+    """
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_bookings_event_status
+    ON bookings (event_id, status, id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS refunds (
+        id SERIAL PRIMARY KEY,
+        booking_id INTEGER UNIQUE REFERENCES bookings(id) ON DELETE SET NULL,
+        user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+        event_id INTEGER NOT NULL REFERENCES events(id),
+        amount DECIMAL(10, 2) NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notifications (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+        event_id INTEGER REFERENCES events(id),
+        booking_id INTEGER REFERENCES bookings(id) ON DELETE SET NULL,
+        message TEXT NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    ALTER TABLE refunds
+        ALTER COLUMN booking_id DROP NOT NULL,
+        ALTER COLUMN user_id DROP NOT NULL,
+        DROP CONSTRAINT IF EXISTS refunds_booking_id_fkey,
+        ADD CONSTRAINT refunds_booking_id_fkey
+            FOREIGN KEY (booking_id) REFERENCES bookings(id) ON DELETE SET NULL,
+        DROP CONSTRAINT IF EXISTS refunds_user_id_fkey,
+        ADD CONSTRAINT refunds_user_id_fkey
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+    """,
+    """
+    ALTER TABLE notifications
+        ALTER COLUMN user_id DROP NOT NULL,
+        DROP CONSTRAINT IF EXISTS notifications_booking_id_fkey,
+        ADD CONSTRAINT notifications_booking_id_fkey
+            FOREIGN KEY (booking_id) REFERENCES bookings(id) ON DELETE SET NULL,
+        DROP CONSTRAINT IF EXISTS notifications_user_id_fkey,
+        ADD CONSTRAINT notifications_user_id_fkey
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notifications_pending
+    ON notifications (status, id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS event_cancellation_jobs (
+        event_id INTEGER PRIMARY KEY REFERENCES events(id),
+        status VARCHAR(20) NOT NULL DEFAULT 'running',
+        last_booking_id INTEGER NOT NULL DEFAULT 0,
+        processed_count INTEGER NOT NULL DEFAULT 0,
+        total_count INTEGER NOT NULL DEFAULT 0,
+        started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        completed_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS waitlist_entries (
+        id SERIAL PRIMARY KEY,
+        event_id INTEGER NOT NULL REFERENCES events(id),
+        user_id INTEGER NOT NULL REFERENCES users(id),
+        num_tickets INTEGER NOT NULL CHECK (num_tickets > 0),
+        status VARCHAR(20) NOT NULL DEFAULT 'waiting',
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        offered_at TIMESTAMP,
+        claim_expires_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_waitlist_queue
+    ON waitlist_entries (event_id, id) WHERE status = 'waiting'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_waitlist_offers
+    ON waitlist_entries (event_id, claim_expires_at) WHERE status = 'offered'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_waitlist_user
+    ON waitlist_entries (user_id, status)
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notify_event_availability() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('event_availability', json_build_object(
+            'id', NEW.id,
+            'available_tickets', NEW.available_tickets,
+            'status', NEW.status
+        )::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DROP TRIGGER IF EXISTS events_availability_notify ON events
+    """,
+    """
+    CREATE TRIGGER events_availability_notify
+    AFTER UPDATE OF available_tickets, status ON events
+    FOR EACH ROW
+    WHEN (OLD.available_tickets IS DISTINCT FROM NEW.available_tickets
+          OR OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE PROCEDURE notify_event_availability()
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS audit_log (
+        id BIGSERIAL PRIMARY KEY,
+        occurred_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        actor_id INTEGER,
+        action VARCHAR(50) NOT NULL,
+        entity_type VARCHAR(20) NOT NULL,
+        entity_id INTEGER,
+        event_id INTEGER,
+        ticket_delta INTEGER NOT NULL DEFAULT 0,
+        details JSONB
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_audit_log_event ON audit_log (event_id)
+    """,
+    """
+    CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'audit_log is append-only';
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DROP TRIGGER IF EXISTS audit_log_no_change ON audit_log
+    """,
+    """
+    CREATE TRIGGER audit_log_no_change
+    BEFORE UPDATE OR DELETE ON audit_log
+    FOR EACH ROW EXECUTE PROCEDURE audit_log_append_only()
+    """,
+    """
+    INSERT INTO audit_log (action, entity_type, entity_id, event_id, ticket_delta)
+    SELECT 'inventory_baseline', 'event', e.id, e.id, e.available_tickets
+    FROM events e
+    WHERE NOT EXISTS (SELECT 1 FROM audit_log l WHERE l.event_id = e.id)
+    """,
+    """
+    ALTER TABLE events ADD COLUMN IF NOT EXISTS max_tickets_per_booking INTEGER
+    """,
+    """
+    ALTER TABLE events ADD COLUMN IF NOT EXISTS max_tickets_per_user INTEGER
+    """,
+    """
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS booking_window_start TIMESTAMP
+    """,
+    """
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS booking_window_count INTEGER NOT NULL DEFAULT 0
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_event_tickets (
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        event_id INTEGER NOT NULL REFERENCES events(id),
+        tickets INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, event_id)
+    )
+    """,
+    """
+    INSERT INTO user_event_tickets (user_id, event_id, tickets)
+    SELECT user_id, event_id, SUM(num_tickets)
+    FROM bookings
+    WHERE status = 'active'
+    GROUP BY user_id, event_id
+    ON CONFLICT (user_id, event_id) DO NOTHING
+    """,
+    """
+    ALTER TABLE events ADD COLUMN IF NOT EXISTS cancellation_window_hours INTEGER
+    """,
+    """
+    ALTER TABLE events ADD COLUMN IF NOT EXISTS waitlist_held_tickets INTEGER NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE bookings ADD COLUMN IF NOT EXISTS cancellable_until TIMESTAMP
+    """,
+    """
+    ALTER TABLE bookings ADD COLUMN IF NOT EXISTS cancellation_open BOOLEAN NOT NULL DEFAULT TRUE
+    """,
+    f"""
+    UPDATE bookings b
+    SET cancellable_until = LEAST(
+        b.created_at + make_interval(hours => COALESCE(e.cancellation_window_hours, {Config.DEFAULT_CANCELLATION_WINDOW_HOURS})),
+        e.date::timestamp)
+    FROM events e
+    WHERE b.event_id = e.id AND b.cancellable_until IS NULL
+    """,
+    """
+    DROP INDEX IF EXISTS idx_bookings_cancellable
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_bookings_user_active
+    ON bookings (user_id, booking_date) WHERE status = 'active'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_bookings_cancellation_deadline
+    ON bookings (cancellable_until) WHERE status = 'active' AND cancellation_open
+    """,
+]
+
+# Query profiling.
+# Connections are created as ProfiledConnection, whose cursors time every
+# execute() and record it on the current request: query count, database time
+# and rows returned, plus per-statement counts so a statement run over and
+# over with different parameters (an N+1 loop) stands out. Totals per
+# statement are also kept for the life of the process and listed, hottest
+# first, at /admin/query_stats.
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        # statement -> [executions, seconds, rows, distinct parameter sets]
+        self.statements = {}
+    
+    def record(self, statement, params, seconds, rows):
+        self.count += 1
+        self.seconds += seconds
+        self.rows += rows
+        entry = self.statements.setdefault(statement, [0, 0.0, 0, set()])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += rows
+        entry[3].add(repr(params))
+    
+    # Statements repeated at least N_PLUS_ONE_THRESHOLD times with varying parameters
+    def repeated(self):
+        return [(statement, entry[0]) for statement, entry in self.statements.items()
+                if entry[0] >= Config.N_PLUS_ONE_THRESHOLD and len(entry[3]) > 1]
+
+# statement -> [executions, seconds, rows] across all requests in this process
+query_totals = {}
+query_totals_lock = threading.Lock()
+
+def record_query(statement, params, seconds, rows):
+    statement = ' '.join(statement.split())
+    
+    stats = g.get('query_stats') if has_request_context() else None
+    if stats is not None:
+        stats.record(statement, params, seconds, rows)
+    
+    with query_totals_lock:
+        totals = query_totals.setdefault(statement, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += rows
+
+# Mixed into whichever cursor class the caller asks for
+class ProfilingCursor:
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.record(query, vars, time.perf_counter() - start)
+    
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.record(query, None, time.perf_counter() - start)
+    
+    def record(self, query, params, seconds):
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        elif isinstance(query, bytes):
+            query = query.decode()
+        # rowcount is the number of rows returned only for statements with a result set
+        rows = max(self.rowcount, 0) if self.description is not None else 0
+        record_query(query, params, seconds, rows)
+
+profiled_cursor_classes = {}
+
+def profiled_cursor_class(factory):
+    cls = profiled_cursor_classes.get(factory)
+    if cls is None:
+        cls = type('Profiled' + factory.__name__, (ProfilingCursor, factory), {})
+        profiled_cursor_classes[factory] = cls
+    return cls
+
+class ProfiledConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = profiled_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+# Route decorator: a request running more than max_queries statements is
+# logged, or fails with QueryBudgetExceeded when QUERY_BUDGET_STRICT is set
+def query_budget(max_queries):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            response = view(*args, **kwargs)
+            stats = g.get('query_stats')
+            if stats is not None and stats.count > max_queries:
+                message = f"{request.endpoint} ran {stats.count} queries, budget is {max_queries}"
+                if Config.QUERY_BUDGET_STRICT:
+                    raise QueryBudgetExceeded(message)
+                print(f"Query budget exceeded: {message}")
+            return response
+        return wrapper
+    return decorator
+
+# Replica health: index -> time before which the replica is skipped
+replica_unhealthy_until = {}
+# index -> time until which the last passed lag check is trusted
+replica_checked_until = {}
+replica_lock = threading.Lock()
+replica_next = 0
+
+def connect_to(host, port):
+    conn = psycopg2.connect(
+        dbname=Config.DB_NAME,
+        user=Config.DB_USER,
+        password=Config.DB_PASSWORD,
+        host=host,
+        port=port,
+        connect_timeout=Config.DB_CONNECT_TIMEOUT,
+        application_name=Config.DB_APPLICATION_NAME,
+        connection_factory=ProfiledConnection if Config.QUERY_PROFILING else None
+    )
+    conn.autocommit = False
+    return conn
+
+# Pick the next healthy replica (round robin) and check its replication lag.
+# A replica that is streaming from the primary (and heard from it within
+# REPLICA_RECEIVER_TIMEOUT_SECONDS) and has replayed everything it received
+# is caught up, however long ago the primary last wrote. Otherwise, including
+# when its WAL receiver has disconnected, the age of the last replayed
+# transaction is taken as lag, and a replica that has replayed nothing is
+# skipped. Reading pg_stat_wal_receiver needs the pg_read_all_stats role. A
+# passed check is reused for REPLICA_CHECK_SECONDS so most reads cost no
+# extra round trip.
+def get_replica_connection():
+    global replica_next
+    
+    for _ in range(len(Config.DB_REPLICAS)):
+        with replica_lock:
+            index = replica_next % len(Config.DB_REPLICAS)
+            replica_next += 1
+            if replica_unhealthy_until.get(index, 0) > time.time():
+                continue
+            checked = replica_checked_until.get(index, 0) > time.time()
+        
+        host, port = Config.DB_REPLICAS[index]
+        try:
+            conn = connect_to(host, port)
+            if checked:
+                return conn
+            
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT CASE
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                             AND EXISTS (
+                                 SELECT 1 FROM pg_stat_wal_receiver
+                                 WHERE status = 'streaming'
+                                   AND last_msg_receipt_time > now() - make_interval(secs => %s)
+                             )
+                        THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8,
+                                      'Infinity')
+                    END
+                    WHERE pg_is_in_recovery()
+                """, (Config.REPLICA_RECEIVER_TIMEOUT_SECONDS,))
+                row = cur.fetchone()
+            conn.rollback()
+            
+            lag = float(row[0]) if row else 0
+            if lag > Config.REPLICA_MAX_LAG_SECONDS:
+                print(f"Replica {host}:{port} is {lag:.1f}s behind, skipping")
+                conn.close()
+                with replica_lock:
+                    replica_unhealthy_until[index] = time.time() + Config.REPLICA_RETRY_SECONDS
+                continue
+            
+            with replica_lock:
+                replica_checked_until[index] = time.time() + Config.REPLICA_CHECK_SECONDS
+            return conn
+        except Exception as e:
+            print(f"Replica {host}:{port} connection error: {e}")
+            with replica_lock:
+                replica_unhealthy_until[index] = time.time() + Config.REPLICA_RETRY_SECONDS
+    
+    return None
 
 # Database connection function
-def get_db_connection():
+# Read-only callers pass readonly=True to be routed to a replica when one is
+# configured and healthy, unless the current user has just written something.
+def get_db_connection(readonly=False):
+    if readonly and Config.DB_REPLICAS:
+        last_write = session.get('last_write_at', 0) if has_request_context() else 0
+        if time.time() - last_write > Config.READ_YOUR_WRITES_SECONDS:
+            conn = get_replica_connection()
+            if conn:
+                return conn
+    
     try:
         # Connect to your PostgreSQL database
-        conn = psycopg2.connect(
-            dbname=os.environ.get('DB_NAME', 'event_booking'),
-            user=os.environ.get('DB_USER', 'postgres'),
-            password=os.environ.get('DB_PASSWORD', 'postgres'),
-            host=os.environ.get('DB_HOST', 'localhost'),
-            port=os.environ.get('DB_PORT', '5432')
-        )
-        conn.autocommit = False
+        conn = connect_to(Config.DB_HOST, Config.DB_PORT)
         print("Successfully connected to database")
         return conn
     except Exception as e:
@@ -29,143 +555,1041 @@ def get_db_connection():
         return None
 
 # Initialize database
-def init_db():
+# Creates the schema on an empty database, otherwise seeds sample events if
+# there are none; then applies SCHEMA_UPGRADES. Runs on the caller's connection.
+def init_db(conn):
+    with conn.cursor() as cur:
+        # Check if tables exist
+        cur.execute("SELECT to_regclass('public.users') IS NOT NULL")
+        tables_exist = cur.fetchone()[0]
+        
+        if not tables_exist:
+            # Create tables from schema.sql
+            print("Creating database tables...")
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'), 'r') as f:
+                cur.execute(f.read())
+            print("Database tables created")
+        else:
+            print("Tables already exist, checking data...")
+            # Insert sample artists and events only if there are no events yet
+            cur.execute("SELECT EXISTS (SELECT 1 FROM events)")
+            if not cur.fetchone()[0]:
+                print("No events found. Creating sample events...")
+                cur.execute("SELECT EXISTS (SELECT 1 FROM artists)")
+                if not cur.fetchone()[0]:
+                    print("No artists found. Creating sample artists...")
+                    cur.execute("""
+                        INSERT INTO artists (name, description) VALUES
+                        ('John Doe', 'Famous rock artist'),
+                        ('Jane Smith', 'Popular pop singer'),
+                        ('The Band', 'Indie rock band')
+                    """)
+                
+                # Get first artist ID
+                cur.execute("SELECT id FROM artists LIMIT 1")
+                artist_id = cur.fetchone()[0]
+                
+                # Insert sample events
+                cur.execute("""
+                    INSERT INTO events (name, description, date, venue, price, available_tickets, artist_id, status) VALUES
+                    ('Summer Concert', 'Annual summer concert with great music', '2024-07-15', 'Venue A', 50.00, 200, %s, 'active'),
+                    ('Rock Festival', 'The biggest rock festival of the year', '2024-08-20', 'Venue B', 75.00, 500, %s, 'active'),
+                    ('Acoustic Night', 'A night of acoustic performances', '2024-06-10', 'Venue C', 30.00, 100, %s, 'active'),
+                    ('Jazz Evening', 'Enjoy the best jazz music', '2024-09-05', 'Venue A', 45.00, 150, %s, 'active')
+                """, (artist_id, artist_id, artist_id, artist_id))
+                print("Sample events created successfully")
+        
+        # Create contact_submissions table if missing
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS contact_submissions (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100) NOT NULL,
+                email VARCHAR(100) NOT NULL,
+                message TEXT NOT NULL,
+                submission_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                status VARCHAR(20) NOT NULL DEFAULT 'unread'
+            )
+        """)
+        
+        # Bring older databases up to date
+        for statement in SCHEMA_UPGRADES:
+            cur.execute(statement)
+        conn.commit()
+        print("Database initialized successfully")
+        
+        return True
+
+# Create admin user if not exists
+def ensure_admin_exists(conn):
+    with conn.cursor() as cur:
+        # Check if admin exists
+        cur.execute("SELECT id FROM users WHERE email = %s", ("admin@example.com",))
+        if cur.fetchone():
+            print("Admin user already exists")
+            return True
+        
+        # Create admin user
+        hashed_password = generate_password_hash("admin123")
+        cur.execute("""
+            INSERT INTO users (
+                first_name, last_name, email, password, is_admin
+            )
+            VALUES (%s, %s, %s, %s, %s)
+        """, (
+            "Admin", "User", "admin@example.com", hashed_password, True
+        ))
+        
+        conn.commit()
+        print("Admin user created successfully")
+        return True
+
+# Set up schema, sample data and the admin account over a single connection
+def bootstrap_db():
     conn = get_db_connection()
     if not conn:
         print("Failed to connect to database for initialization")
         return False
     
     try:
+        return init_db(conn) and ensure_admin_exists(conn)
+    except Exception as e:
+        print(f"Error initializing database: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the schema and make sure the admin user exists."""
+    if not bootstrap_db():
+        raise SystemExit(1)
+
+# Audit log.
+# audit() stages a row for the current request (or thread); commit() commits
+# the transaction and only then moves the staged rows to the in-memory
+# buffer, so rolled-back work never reaches the log. A background thread
+# writes the buffer with COPY every AUDIT_FLUSH_SECONDS or once
+# AUDIT_BATCH_SIZE rows are waiting, keeping the insert off the request path.
+# ticket_delta records every change to an event's available_tickets so the
+# log can be replayed to check inventory (see verify-inventory).
+AUDIT_COLUMNS = ('occurred_at', 'actor_id', 'action', 'entity_type',
+                 'entity_id', 'event_id', 'ticket_delta', 'details')
+
+audit_buffer = []
+audit_buffer_lock = threading.Lock()
+audit_flush_wanted = threading.Event()
+audit_flusher = None
+audit_local = threading.local()
+
+def staged_audit():
+    if has_app_context():
+        if 'audit_pending' not in g:
+            g.audit_pending = []
+        return g.audit_pending
+    if not hasattr(audit_local, 'pending'):
+        audit_local.pending = []
+    return audit_local.pending
+
+def audit(action, entity_type, entity_id, event_id=None, ticket_delta=0, **details):
+    actor_id = session.get('user_id') if has_request_context() else None
+    staged_audit().append((
+        datetime.now(), actor_id, action, entity_type, entity_id, event_id,
+        ticket_delta, json.dumps(details, default=str) if details else None
+    ))
+
+def commit(conn):
+    conn.commit()
+    
+    staged = staged_audit()
+    if staged:
+        with audit_buffer_lock:
+            audit_buffer.extend(staged)
+            full = len(audit_buffer) >= Config.AUDIT_BATCH_SIZE
+        staged.clear()
+        
+        ensure_audit_flusher()
+        if full:
+            audit_flush_wanted.set()
+
+def rollback(conn):
+    conn.rollback()
+    staged_audit().clear()
+
+# Write buffered audit rows with a single COPY; rows are kept on failure
+def flush_audit_log():
+    with audit_buffer_lock:
+        rows = audit_buffer[:]
+        audit_buffer.clear()
+    
+    if not rows:
+        return 0
+    
+    conn = get_db_connection()
+    if not conn:
+        with audit_buffer_lock:
+            audit_buffer[:0] = rows
+        return 0
+    
+    try:
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        
         with conn.cursor() as cur:
-            # Check if tables exist
+            cur.copy_expert(f"COPY audit_log ({', '.join(AUDIT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", data)
+        conn.commit()
+        return len(rows)
+    except Exception as e:
+        print(f"Error writing audit log: {e}")
+        conn.rollback()
+        with audit_buffer_lock:
+            audit_buffer[:0] = rows
+        return 0
+    finally:
+        conn.close()
+
+def audit_flush_loop():
+    while True:
+        audit_flush_wanted.wait(Config.AUDIT_FLUSH_SECONDS)
+        audit_flush_wanted.clear()
+        flush_audit_log()
+
+# Start this process's flusher thread on first use
+def ensure_audit_flusher():
+    global audit_flusher
+    
+    with audit_buffer_lock:
+        if audit_flusher is None or not audit_flusher.is_alive():
+            audit_flusher = threading.Thread(target=audit_flush_loop, daemon=True)
+            audit_flusher.start()
+
+# Don't lose the last batch on shutdown
+atexit.register(flush_audit_log)
+
+# Replay the audit log and compare the result with events.available_tickets.
+# Rows still buffered in other running processes are not visible yet, and a
+# killed process loses its unflushed rows, so on a live system the report can
+# show drift that isn't there. Corrections are therefore only applied while
+# no other app process is connected; each event is locked, re-checked and
+# moved by the difference, so nothing committed meanwhile is overwritten.
+def verify_inventory(apply=False):
+    flush_audit_log()
+    
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to database for inventory check")
+        return None
+    
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_schema = 'public' AND table_name = 'users'
-                )
+                SELECT e.id, e.name, e.available_tickets,
+                       COALESCE(SUM(l.ticket_delta), 0) as replayed
+                FROM events e
+                LEFT JOIN audit_log l ON l.event_id = e.id
+                GROUP BY e.id
+                ORDER BY e.id
             """)
-            tables_exist = cur.fetchone()[0]
             
-            if not tables_exist:
-                # Create tables from schema.sql
-                print("Creating database tables...")
-                with open('schema.sql', 'r') as f:
-                    cur.execute(f.read())
-                conn.commit()
-                print("Database initialized successfully")
-                return True
-            else:
-                print("Tables already exist, checking data...")
-                # Check if events table has data
-                cur.execute("SELECT COUNT(*) FROM events")
-                event_count = cur.fetchone()[0]
-                print(f"Found {event_count} events in database")
-                
-                # If no events exist, insert sample events
-                if event_count == 0:
-                    print("No events found. Creating sample events...")
-                    # Insert sample artists if needed
-                    cur.execute("SELECT COUNT(*) FROM artists")
-                    artist_count = cur.fetchone()[0]
-                    if artist_count == 0:
-                        print("No artists found. Creating sample artists...")
-                        cur.execute("""
-                            INSERT INTO artists (name, description) VALUES
-                            ('John Doe', 'Famous rock artist'),
-                            ('Jane Smith', 'Popular pop singer'),
-                            ('The Band', 'Indie rock band')
-                        """)
-                    
-                    # Get first artist ID
-                    cur.execute("SELECT id FROM artists LIMIT 1")
-                    artist_id = cur.fetchone()[0]
-                    
-                    # Insert sample events
-                    cur.execute("""
-                        INSERT INTO events (name, description, date, venue, price, available_tickets, artist_id, status) VALUES
-                        ('Summer Concert', 'Annual summer concert with great music', '2024-07-15', 'Venue A', 50.00, 200, %s, 'active'),
-                        ('Rock Festival', 'The biggest rock festival of the year', '2024-08-20', 'Venue B', 75.00, 500, %s, 'active'),
-                        ('Acoustic Night', 'A night of acoustic performances', '2024-06-10', 'Venue C', 30.00, 100, %s, 'active'),
-                        ('Jazz Evening', 'Enjoy the best jazz music', '2024-09-05', 'Venue A', 45.00, 150, %s, 'active')
-                    """, (artist_id, artist_id, artist_id, artist_id))
-                    
-                    conn.commit()
-                    print("Sample events created successfully")
-                
-                # Check if contact_submissions table exists, create if not
+            mismatches = [event for event in cur.fetchall()
+                          if event['available_tickets'] != event['replayed']]
+            conn.rollback()
+            
+            for event in mismatches:
+                print(f"Event {event['id']} ({event['name']}): "
+                      f"available_tickets={event['available_tickets']}, log says {event['replayed']}")
+            print(f"{len(mismatches)} events out of sync")
+            
+            if not apply or not mismatches:
+                return mismatches
+            
+            cur.execute("""
+                SELECT COUNT(*) as serving FROM pg_stat_activity
+                WHERE datname = current_database() AND application_name = %s
+                  AND pid <> pg_backend_pid()
+            """, (Config.DB_APPLICATION_NAME,))
+            serving = cur.fetchone()['serving']
+            conn.rollback()
+            if serving:
+                print(f"Not applying: {serving} other app connections are open. Stop all app servers first.")
+                return None
+            
+            for event in mismatches:
                 cur.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.tables 
-                        WHERE table_schema = 'public' AND table_name = 'contact_submissions'
-                    )
-                """)
-                contact_table_exists = cur.fetchone()[0]
+                    SELECT available_tickets FROM events WHERE id = %s FOR UPDATE
+                """, (event['id'],))
+                available = cur.fetchone()['available_tickets']
+                cur.execute("""
+                    SELECT COALESCE(SUM(ticket_delta), 0) as replayed FROM audit_log WHERE event_id = %s
+                """, (event['id'],))
+                correction = cur.fetchone()['replayed'] - available
                 
-                if not contact_table_exists:
-                    print("Creating contact_submissions table...")
+                if correction:
                     cur.execute("""
-                        CREATE TABLE contact_submissions (
-                            id SERIAL PRIMARY KEY,
-                            name VARCHAR(100) NOT NULL,
-                            email VARCHAR(100) NOT NULL,
-                            message TEXT NOT NULL,
-                            submission_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                            status VARCHAR(20) NOT NULL DEFAULT 'unread'
-                        )
-                    """)
-                    conn.commit()
-                    print("Contact submissions table created successfully")
-                
-                return True
+                        UPDATE events SET available_tickets = available_tickets + %s WHERE id = %s
+                    """, (correction, event['id']))
+                    # Brings the row in line with the log, so it adds no delta of its own
+                    audit('inventory_corrected', 'event', event['id'], event['id'], correction=correction)
+                    print(f"Event {event['id']}: corrected available_tickets by {correction:+d}")
+                commit(conn)
+            return mismatches
     except Exception as e:
-        print(f"Error initializing database: {e}")
+        print(f"Error verifying inventory: {e}")
         conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+@bp.cli.command('verify-inventory')
+@click.option('--apply', is_flag=True,
+              help='Correct available_tickets from the audit log. Only with all app servers stopped.')
+def verify_inventory_command(apply):
+    """Replay the audit log and check available_tickets for every event."""
+    if apply:
+        click.confirm("The audit log is only complete once every app server has stopped "
+                      "and flushed it. Are all app servers stopped?", abort=True)
+    mismatches = verify_inventory(apply)
+    if mismatches is None or (mismatches and not apply):
+        raise SystemExit(1)
+
+# Compare submitted form values with the current row and keep only the
+# columns that actually changed. Empty strings and NULL count as equal.
+def changed_columns(current, submitted):
+    def normalize(value):
+        return None if value == '' else value
+    
+    return {column: value for column, value in submitted.items()
+            if normalize(current[column]) != normalize(value)}
+
+# "SET a = %s, b = %s" for the given columns, plus any extra assignments
+def set_clause(columns, *extra):
+    assignments = [sql.SQL('{} = %s').format(sql.Identifier(column)) for column in columns]
+    assignments.extend(sql.SQL(assignment) for assignment in extra)
+    return sql.SQL(', ').join(assignments)
+
+# Cancel one batch of active bookings for a cancelled event.
+# Each batch runs in its own short transaction so row locks on bookings are
+# never held for long, and the job row records how far we got so a crashed
+# run can pick up where it left off.
+def cancel_event_bookings_batch(conn, event_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT last_booking_id, status
+            FROM event_cancellation_jobs
+            WHERE event_id = %s
+            FOR UPDATE
+        """, (event_id,))
+        
+        job = cur.fetchone()
+        if not job or job[1] == 'completed':
+            conn.rollback()
+            return 0
+        
+        # Cancel the batch, record refunds and queue notifications in one statement
+        cur.execute("""
+            WITH batch AS (
+                SELECT id
+                FROM bookings
+                WHERE event_id = %s AND status = 'active' AND id > %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE
+            ), cancelled AS (
+                UPDATE bookings b
+                SET status = 'cancelled'
+                FROM batch
+                WHERE b.id = batch.id
+                RETURNING b.id, b.user_id, b.total_price
+            ), refunded AS (
+                INSERT INTO refunds (booking_id, user_id, event_id, amount)
+                SELECT id, user_id, %s, total_price FROM cancelled
+                ON CONFLICT (booking_id) DO NOTHING
+            ), notified AS (
+                INSERT INTO notifications (user_id, event_id, booking_id, message)
+                SELECT c.user_id, %s, c.id, 'Your booking for ' || e.name ||
+                       ' has been cancelled because the event was cancelled. A refund of PKR' ||
+                       c.total_price || ' has been issued.'
+                FROM cancelled c
+                JOIN events e ON e.id = %s
+            )
+            SELECT COUNT(*), MAX(id) FROM cancelled
+        """, (event_id, job[0], Config.CANCELLATION_BATCH_SIZE, event_id, event_id, event_id))
+        
+        count, last_id = cur.fetchone()
+        
+        if count:
+            cur.execute("""
+                UPDATE event_cancellation_jobs
+                SET last_booking_id = %s, processed_count = processed_count + %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE event_id = %s
+            """, (last_id, count, event_id))
+            audit('event_bookings_cancelled', 'event', event_id, event_id,
+                  bookings=count, last_booking_id=last_id)
+        else:
+            cur.execute("""
+                UPDATE event_cancellation_jobs
+                SET status = 'completed', updated_at = CURRENT_TIMESTAMP,
+                    completed_at = CURRENT_TIMESTAMP
+                WHERE event_id = %s
+            """, (event_id,))
+        
+        commit(conn)
+        return count
+
+# Advisory lock class for cancellation jobs; the second key is the event id
+CANCELLATION_JOB_LOCK = 1
+
+# Run the cancellation job for an event until every active booking is refunded.
+# The job holds a session advisory lock for as long as it runs, so a job is
+# only ever worked on by one process and is free to be resumed as soon as
+# that process dies.
+def process_event_cancellation(event_id):
+    conn = get_db_connection()
+    if not conn:
+        print(f"Failed to connect to database for cancelling event {event_id}")
+        return False
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (CANCELLATION_JOB_LOCK, event_id))
+            locked = cur.fetchone()[0]
+        commit(conn)
+        if not locked:
+            print(f"Event {event_id}: cancellation is already being processed")
+            return True
+        
+        total = 0
+        while True:
+            count = cancel_event_bookings_batch(conn, event_id)
+            if not count:
+                break
+            total += count
+            print(f"Event {event_id}: cancelled {total} bookings so far")
+        print(f"Event {event_id}: cancellation finished, {total} bookings refunded")
+        return True
+    except Exception as e:
+        print(f"Error processing cancellation for event {event_id}: {e}")
+        rollback(conn)
         return False
     finally:
         conn.close()
 
-# Create admin user if not exists
-def ensure_admin_exists():
+# Resume cancellation jobs that were interrupted (e.g. by a crash or restart).
+# Jobs still held by a live process are skipped by process_event_cancellation().
+def resume_event_cancellations():
     conn = get_db_connection()
     if not conn:
-        print("Failed to connect to database for admin creation")
+        print("Failed to connect to database for resuming cancellations")
         return False
     
     try:
         with conn.cursor() as cur:
-            # Check if admin exists
-            cur.execute("SELECT id FROM users WHERE email = %s", ("admin@example.com",))
-            if cur.fetchone():
-                print("Admin user already exists")
-                return True
-            
-            # Create admin user
-            hashed_password = generate_password_hash("admin123")
             cur.execute("""
-                INSERT INTO users (
-                    first_name, last_name, email, password, is_admin
+                SELECT event_id FROM event_cancellation_jobs
+                WHERE status = 'running'
+                ORDER BY started_at
+            """)
+            event_ids = [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        print(f"Error loading cancellation jobs: {e}")
+        return False
+    finally:
+        conn.close()
+    
+    for event_id in event_ids:
+        print(f"Resuming cancellation for event {event_id}")
+        process_event_cancellation(event_id)
+    return True
+
+# Every worker periodically picks up cancellation jobs whose process was
+# recycled, reloaded or killed, so no operator action is needed
+cancellation_resumer = None
+cancellation_resumer_lock = threading.Lock()
+
+def cancellation_resume_loop():
+    while True:
+        try:
+            resume_event_cancellations()
+        except Exception as e:
+            print(f"Error resuming cancellations: {e}")
+        time.sleep(Config.CANCELLATION_RESUME_SECONDS)
+
+def ensure_cancellation_resumer():
+    global cancellation_resumer
+    
+    with cancellation_resumer_lock:
+        if cancellation_resumer is None or not cancellation_resumer.is_alive():
+            cancellation_resumer = threading.Thread(target=cancellation_resume_loop, daemon=True)
+            cancellation_resumer.start()
+
+# Fixed-window rate limit on booking attempts per user, one indexed row
+# update. Every attempt counts, including ones that then fail because the
+# event is sold out or over a limit, so the counter is committed in its own
+# short transaction before the caller starts taking tickets.
+def check_booking_velocity(conn, user_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE users
+            SET booking_window_count = CASE
+                    WHEN booking_window_start > CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    THEN booking_window_count + 1 ELSE 1 END,
+                booking_window_start = CASE
+                    WHEN booking_window_start > CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    THEN booking_window_start ELSE CURRENT_TIMESTAMP END
+            WHERE id = %s
+            RETURNING booking_window_count
+        """, (Config.BOOKING_VELOCITY_WINDOW_SECONDS, Config.BOOKING_VELOCITY_WINDOW_SECONDS, user_id))
+        
+        row = cur.fetchone()
+    commit(conn)
+    
+    return row is not None and row[0] <= Config.BOOKING_VELOCITY_LIMIT
+
+# Add tickets to the user's running total for an event unless that would take
+# it over the limit. The running total is kept up to date on every booking
+# and cancellation, so no SUM over bookings is needed.
+def reserve_user_tickets(cur, user_id, event_id, num_tickets, limit):
+    if num_tickets > limit:
+        return False
+    
+    cur.execute("""
+        INSERT INTO user_event_tickets (user_id, event_id, tickets)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (user_id, event_id) DO UPDATE
+        SET tickets = user_event_tickets.tickets + EXCLUDED.tickets
+        WHERE user_event_tickets.tickets + EXCLUDED.tickets <= %s
+        RETURNING tickets
+    """, (user_id, event_id, num_tickets, limit))
+    
+    return cur.fetchone() is not None
+
+# Per-event limit from a form field; blank means use the default
+def parse_ticket_limit(value):
+    if not value:
+        return None
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    return limit
+
+# Per-event cancellation window in hours from a form field; blank means use
+# the default, 0 means bookings can't be cancelled
+def parse_cancellation_window(value):
+    if not value:
+        return None
+    hours = int(value)
+    if hours < 0:
+        raise ValueError("cancellation window can't be negative")
+    return hours
+
+def release_user_tickets(cur, user_id, event_id, num_tickets):
+    cur.execute("""
+        UPDATE user_event_tickets
+        SET tickets = GREATEST(tickets - %s, 0)
+        WHERE user_id = %s AND event_id = %s
+    """, (num_tickets, user_id, event_id))
+
+# Hand freed tickets to an event's waitlist.
+# Runs inside the caller's transaction on its own plain cursor. Expired offers
+# are returned to the pool first and entries that waited longer than
+# WAITLIST_MAX_WAIT_HOURS are dropped, then waiting entries are offered in
+# FIFO order, skipping any that want more tickets than are left, so one large
+# request doesn't block smaller ones behind it. Each offer is one indexed
+# statement; entries locked by someone leaving the waitlist are skipped.
+# Offered tickets are held off the public pool until they are claimed or the
+# offer expires. Tickets left over while people are still waiting (everyone
+# waiting wants more than is free) are kept in waitlist_held_tickets rather
+# than going back on public sale, and return to the public pool once nobody
+# is waiting; waiting entries expire, so this can't last indefinitely.
+def promote_waitlist(conn, event_id):
+    with conn.cursor() as cur:
+        # Return tickets from offers that were never claimed and drop entries
+        # that have waited too long (only offered entries have offered_at)
+        cur.execute("""
+            WITH expired AS (
+                UPDATE waitlist_entries
+                SET status = 'expired'
+                WHERE event_id = %s
+                  AND ((status = 'offered' AND claim_expires_at < CURRENT_TIMESTAMP)
+                       OR (status = 'waiting'
+                           AND created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)))
+                RETURNING CASE WHEN offered_at IS NULL THEN 0 ELSE num_tickets END AS returned
+            )
+            UPDATE events
+            SET available_tickets = available_tickets + (SELECT COALESCE(SUM(returned), 0) FROM expired)
+            WHERE id = %s
+            RETURNING available_tickets, waitlist_held_tickets, status,
+                      (SELECT COALESCE(SUM(returned), 0) FROM expired)
+        """, (event_id, Config.WAITLIST_MAX_WAIT_HOURS, event_id))
+        
+        event = cur.fetchone()
+        if not event:
+            return 0
+        
+        available, held, status, returned = event
+        if returned:
+            audit('waitlist_offers_expired', 'event', event_id, event_id, returned)
+        pool = available + held
+        if status != 'active' or pool <= 0:
+            return 0
+        
+        promoted = 0
+        offered = 0
+        while offered < pool:
+            # Offer the earliest waiting entry that fits in what is left
+            cur.execute("""
+                WITH offered AS (
+                    UPDATE waitlist_entries
+                    SET status = 'offered', offered_at = CURRENT_TIMESTAMP,
+                        claim_expires_at = CURRENT_TIMESTAMP + make_interval(mins => %s)
+                    WHERE id = (
+                        SELECT id
+                        FROM waitlist_entries
+                        WHERE event_id = %s AND status = 'waiting' AND num_tickets <= %s
+                        ORDER BY id
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING user_id, num_tickets
+                ), notified AS (
+                    INSERT INTO notifications (user_id, event_id, message)
+                    SELECT o.user_id, %s, 'Tickets for ' || e.name || ' are available for you. ' ||
+                           'Claim your ' || o.num_tickets || ' ticket(s) from your dashboard within ' ||
+                           %s || ' minutes.'
+                    FROM offered o
+                    JOIN events e ON e.id = %s
                 )
-                VALUES (%s, %s, %s, %s, %s)
-            """, (
-                "Admin", "User", "admin@example.com", hashed_password, True
-            ))
+                SELECT num_tickets FROM offered
+            """, (Config.WAITLIST_CLAIM_MINUTES, event_id, pool - offered,
+                  event_id, Config.WAITLIST_CLAIM_MINUTES, event_id))
+        
+            row = cur.fetchone()
+            if not row:
+                break
+            promoted += 1
+            offered += row[0]
+        
+        # Whatever wasn't offered stays with the waitlist while anyone is waiting
+        cur.execute("""
+            SELECT EXISTS (SELECT 1 FROM waitlist_entries WHERE event_id = %s AND status = 'waiting')
+        """, (event_id,))
+        new_held = pool - offered if cur.fetchone()[0] else 0
+        available_change = (pool - offered - new_held) - available
+        
+        # The event row is locked by the first UPDATE, so these relative changes
+        # can't interleave with a booking
+        if offered or new_held != held:
+            cur.execute("""
+                UPDATE events
+                SET available_tickets = available_tickets + %s,
+                    waitlist_held_tickets = waitlist_held_tickets + %s
+                WHERE id = %s
+            """, (available_change, new_held - held, event_id))
+            audit('waitlist_offered' if offered else 'waitlist_hold_changed', 'event', event_id,
+                  event_id, available_change, entries=promoted, offered=offered, held=new_held)
+        if offered:
+            print(f"Event {event_id}: offered {offered} tickets to {promoted} waitlisted users")
+        
+        return promoted
+
+# Take a user off an event's waitlist. Tickets from a pending offer go back to
+# the pool and promote_waitlist() passes them on. The entry is locked before
+# the event, as in promote_waitlist(), whose queue scan skips locked entries,
+# so the two can't deadlock.
+def leave_waitlist(conn, event_id, user_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            WITH left_entries AS (
+                UPDATE waitlist_entries
+                SET status = 'left'
+                WHERE event_id = %s AND user_id = %s AND status IN ('waiting', 'offered')
+                RETURNING id, CASE WHEN offered_at IS NULL THEN 0 ELSE num_tickets END AS returned
+            )
+            UPDATE events
+            SET available_tickets = available_tickets + (SELECT COALESCE(SUM(returned), 0) FROM left_entries)
+            WHERE id = %s
+            RETURNING (SELECT MIN(id) FROM left_entries),
+                      (SELECT COALESCE(SUM(returned), 0) FROM left_entries)
+        """, (event_id, user_id, event_id))
+        
+        entry_id, returned = cur.fetchone()
+        if entry_id is None:
+            return False
+        
+        audit('waitlist_left', 'waitlist', entry_id, event_id, returned, user_id=user_id)
+    
+    promote_waitlist(conn, event_id)
+    return True
+
+# Expire unclaimed waitlist offers and entries that waited too long, and pass
+# the tickets down the queue
+def expire_waitlist_offers():
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to database for expiring waitlist offers")
+        return False
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT event_id FROM waitlist_entries
+                WHERE (status = 'offered' AND claim_expires_at < CURRENT_TIMESTAMP)
+                   OR (status = 'waiting'
+                       AND created_at < CURRENT_TIMESTAMP - make_interval(hours => %s))
+            """, (Config.WAITLIST_MAX_WAIT_HOURS,))
+            event_ids = [row[0] for row in cur.fetchall()]
             
-            conn.commit()
-            print("Admin user created successfully")
-            return True
+            for event_id in event_ids:
+                promote_waitlist(conn, event_id)
+                commit(conn)
+        return True
     except Exception as e:
-        print(f"Error creating admin user: {e}")
-        conn.rollback()
+        print(f"Error expiring waitlist offers: {e}")
+        rollback(conn)
         return False
     finally:
         conn.close()
 
+# Mark bookings whose cancellation deadline has passed, in batches so the
+# row locks are short. cancel_ticket() also checks the deadline itself, so
+# this only keeps the open-window indexes small and can run as often as
+# convenient.
+def close_cancellation_windows():
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect to database for closing cancellation windows")
+        return False
+    
+    closed = 0
+    try:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute("""
+                    UPDATE bookings
+                    SET cancellation_open = FALSE
+                    WHERE id IN (
+                        SELECT id FROM bookings
+                        WHERE status = 'active' AND cancellation_open
+                          AND cancellable_until <= CURRENT_TIMESTAMP
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                """, (Config.CANCELLATION_BATCH_SIZE,))
+                
+                count = cur.rowcount
+                commit(conn)
+                closed += count
+                if count < Config.CANCELLATION_BATCH_SIZE:
+                    break
+        print(f"Closed cancellation window for {closed} bookings")
+        return True
+    except Exception as e:
+        print(f"Error closing cancellation windows: {e}")
+        rollback(conn)
+        return False
+    finally:
+        conn.close()
+
+@bp.cli.command('close-cancellation-windows')
+def close_cancellation_windows_command():
+    """Close cancellation windows whose deadline has passed."""
+    close_cancellation_windows()
+
+@bp.cli.command('expire-waitlist-offers')
+def expire_waitlist_offers_command():
+    """Return unclaimed waitlist tickets, drop stale entries and offer tickets on."""
+    expire_waitlist_offers()
+
+@bp.cli.command('resume-cancellations')
+def resume_cancellations_command():
+    """Finish any interrupted event cancellation jobs."""
+    resume_event_cancellations()
+
+# Live availability.
+# A trigger on events sends a NOTIFY whenever available_tickets or status
+# changes, so booking, cancellation, waitlist promotion and admin edits are
+# all covered and the message only goes out once the transaction commits.
+# Each worker process runs one listener thread that coalesces notifications
+# (latest state per event wins) and publishes them every
+# AVAILABILITY_PUSH_INTERVAL. Streams keep the sequence number they last sent
+# and wait on a condition, so a slow client skips straight to the newest state
+# instead of queueing every intermediate change.
+availability_state = {}
+availability_seq = 0
+availability_changed = threading.Condition()
+availability_listener = None
+availability_listener_lock = threading.Lock()
+
+def publish_availability(updates):
+    global availability_seq
+    
+    with availability_changed:
+        for update in updates:
+            availability_seq += 1
+            availability_state[update['id']] = (availability_seq, update)
+        availability_changed.notify_all()
+
+def listen_for_availability():
+    while True:
+        conn = None
+        pending = {}
+        try:
+            conn = connect_to(Config.DB_HOST, Config.DB_PORT)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("LISTEN event_availability")
+            print("Listening for event availability changes")
+            
+            last_flush = time.time()
+            while True:
+                timeout = max(0, Config.AVAILABILITY_PUSH_INTERVAL - (time.time() - last_flush))
+                if select.select([conn], [], [], timeout) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        update = json.loads(conn.notifies.pop(0).payload)
+                        pending[update['id']] = update
+                
+                if time.time() - last_flush >= Config.AVAILABILITY_PUSH_INTERVAL:
+                    if pending:
+                        publish_availability(list(pending.values()))
+                        pending = {}
+                    last_flush = time.time()
+        except Exception as e:
+            print(f"Availability listener error: {e}")
+            time.sleep(1)
+        finally:
+            if conn:
+                conn.close()
+
+# Start this worker's listener thread on first use
+def ensure_availability_listener():
+    global availability_listener
+    
+    with availability_listener_lock:
+        if availability_listener is None or not availability_listener.is_alive():
+            availability_listener = threading.Thread(target=listen_for_availability, daemon=True)
+            availability_listener.start()
+
+def availability_stream():
+    with availability_changed:
+        last_seen = availability_seq
+    
+    yield "retry: 5000\n\n"
+    while True:
+        with availability_changed:
+            availability_changed.wait_for(lambda: availability_seq > last_seen,
+                                          timeout=Config.SSE_HEARTBEAT_SECONDS)
+            changed = [update for seq, update in availability_state.values() if seq > last_seen]
+            last_seen = availability_seq
+        
+        if changed:
+            yield f"data: {json.dumps(changed)}\n\n"
+        else:
+            yield ": keep-alive\n\n"
+
+# Rendered row fragments keyed by (macro, row id, row version).
+# Each worker keeps its own LRU unless CACHE_URL points at a Redis server,
+# in which case all workers share one cache.
+class LocalFragmentCache:
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get_many(self, keys):
+        with self.lock:
+            found = []
+            for key in keys:
+                html = self.items.get(key)
+                if html is not None:
+                    self.items.move_to_end(key)
+                found.append(html)
+            return found
+    
+    def set_many(self, fragments):
+        with self.lock:
+            self.items.update(fragments)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+class RedisFragmentCache:
+    prefix = 'sems:fragment:'
+    
+    def __init__(self, url, ttl):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+    
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [html.decode() if html is not None else None
+                for html in self.client.mget([self.prefix + key for key in keys])]
+    
+    def set_many(self, fragments):
+        pipe = self.client.pipeline(transaction=False)
+        for key, html in fragments.items():
+            pipe.set(self.prefix + key, html, ex=self.ttl)
+        pipe.execute()
+    
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+fragment_cache = None
+fragment_cache_lock = threading.Lock()
+
+def get_fragment_cache():
+    global fragment_cache
+    
+    with fragment_cache_lock:
+        if fragment_cache is None:
+            if Config.CACHE_URL:
+                fragment_cache = RedisFragmentCache(Config.CACHE_URL, Config.FRAGMENT_CACHE_TTL)
+            else:
+                fragment_cache = LocalFragmentCache(Config.FRAGMENT_CACHE_SIZE)
+        return fragment_cache
+
+# Render one macro from _fragments.html per row, reusing cached HTML.
+# Each row carries a row_version built from the rows it was read from: the
+# xmin of rows whose changing columns are shown, and the version column of
+# events and users whose descriptive columns are shown. Any change to what a
+# fragment displays produces a new key and the stale fragment simply ages out
+# of the cache, while a sale (which rewrites the event row) leaves cached
+# booking fragments alone. All lookups for a page are made in
+# one call (one round trip with Redis).
+def render_fragments(macro_name, rows):
+    cache = get_fragment_cache()
+    keys = [f"{macro_name}:{row['id']}:{row['row_version']}" for row in rows]
+    parts = cache.get_many(keys)
+    
+    missing = {}
+    macro = None
+    for index, html in enumerate(parts):
+        if html is None:
+            macro = macro or get_template_attribute('_fragments.html', macro_name)
+            parts[index] = missing[keys[index]] = str(macro(rows[index]))
+    
+    if missing:
+        cache.set_many(missing)
+    
+    return Markup(''.join(parts))
+
+# Cached bytecode is loaded as code, so the directory must belong to this
+# user and be closed to everyone else (the same check Jinja makes for its
+# default cache directory)
+def template_bytecode_cache(directory):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"Template cache directory {directory} is not a directory owned by this user")
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(directory, 0o700)
+    return FileSystemBytecodeCache(directory)
+
+# Compile the heavy templates up front so the first request doesn't pay for it
+def warm_template_cache(app):
+    for name in ('admin_dashboard.html', 'user_dashboard.html', '_fragments.html'):
+        app.jinja_env.get_template(name)
+
+# Background jobs start with a worker's first request, so CLI commands don't run them
+@bp.before_app_request
+def start_background_jobs():
+    ensure_cancellation_resumer()
+
+@bp.before_app_request
+def start_query_stats():
+    if Config.QUERY_PROFILING:
+        g.query_stats = QueryStats()
+
+# Log each request's database work and expose it to tests (X-Query-Count) and
+# the browser's network panel (Server-Timing)
+@bp.after_app_request
+def report_query_stats(response):
+    stats = g.get('query_stats')
+    if stats is None or not stats.count:
+        return response
+    
+    db_ms = stats.seconds * 1000
+    response.headers['X-Query-Count'] = str(stats.count)
+    response.headers['Server-Timing'] = f'db;dur={db_ms:.1f};desc="{stats.count} queries, {stats.rows} rows"'
+    print(f"{request.method} {request.path}: {stats.count} queries, {db_ms:.1f} ms in database, {stats.rows} rows")
+    for statement, executions in stats.repeated():
+        print(f"Possible N+1 in {request.endpoint}: {executions} runs of {statement[:200]}")
+    return response
+
+# Remember when the user last wrote so their next reads see it
+@bp.after_app_request
+def track_writes(response):
+    if request.method == 'POST':
+        session['last_write_at'] = time.time()
+    return response
+
 # Routes
-@app.route('/')
+@bp.route('/health')
+def health():
+    # Liveness: the process is up and serving, no database needed
+    return jsonify(status='ok')
+
+@bp.route('/ready')
+def ready():
+    # Readiness: the primary database is reachable and the schema is in place
+    conn = get_db_connection()
+    if not conn:
+        return jsonify(status='unavailable', database='unreachable'), 503
+    
+    try:
+        with conn.cursor() as cur:
+            start = time.time()
+            cur.execute("SELECT to_regclass('public.events') IS NOT NULL")
+            schema_ready = cur.fetchone()[0]
+            latency_ms = round((time.time() - start) * 1000, 2)
+        conn.rollback()
+    except Exception as e:
+        return jsonify(status='unavailable', database=f"error: {e}"), 503
+    finally:
+        conn.close()
+    
+    with replica_lock:
+        unhealthy = sum(1 for until in replica_unhealthy_until.values() if until > time.time())
+    
+    body = dict(
+        status='ok' if schema_ready else 'unavailable',
+        database='ok' if schema_ready else 'schema missing, run "flask --app app init-db"',
+        latency_ms=latency_ms,
+        replicas=len(Config.DB_REPLICAS),
+        replicas_unhealthy=unhealthy
+    )
+    return jsonify(body), 200 if schema_ready else 503
+
+@bp.route('/admin/query_stats')
+def query_stats():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return redirect(url_for('.login'))
+    
+    limit = request.args.get('limit', 20, type=int)
+    with query_totals_lock:
+        hottest = sorted(query_totals.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    
+    statements = [dict(
+        statement=statement,
+        executions=executions,
+        total_ms=round(seconds * 1000, 2),
+        mean_ms=round(seconds * 1000 / executions, 3),
+        rows=rows
+    ) for statement, (executions, seconds, rows) in hottest]
+    return jsonify(profiling=Config.QUERY_PROFILING, pid=os.getpid(), statements=statements)
+
+@bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/contact', methods=['POST'])
+@bp.route('/contact', methods=['POST'])
 def contact_submit():
     name = request.form.get('name')
     email = request.form.get('email')
@@ -173,12 +1597,12 @@ def contact_submit():
     
     if not all([name, email, message]):
         flash("Please fill all required fields", "error")
-        return redirect(url_for('index', _anchor='contact'))
+        return redirect(url_for('.index', _anchor='contact'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('index', _anchor='contact'))
+        return redirect(url_for('.index', _anchor='contact'))
     
     try:
         with conn.cursor() as cur:
@@ -186,24 +1610,27 @@ def contact_submit():
             cur.execute("""
                 INSERT INTO contact_submissions (name, email, message)
                 VALUES (%s, %s, %s)
+                RETURNING id
             """, (name, email, message))
             
-            conn.commit()
-            return redirect(url_for('contact_success'))
+            audit('contact_submitted', 'contact', cur.fetchone()[0], email=email)
+            commit(conn)
+            return redirect(url_for('.contact_success'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error submitting form: {e}", "error")
-        return redirect(url_for('index', _anchor='contact'))
+        return redirect(url_for('.index', _anchor='contact'))
     finally:
         conn.close()
 
-@app.route('/contact/success')
+@bp.route('/contact/success')
 def contact_success():
     return render_template('contact_success.html')
 
-@app.route('/events')
+@bp.route('/events')
+@query_budget(2)
 def events():
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     if not conn:
         flash("Database connection error", "error")
         return render_template('events.html', events=[])
@@ -225,7 +1652,28 @@ def events():
     finally:
         conn.close()
 
-@app.route('/register', methods=['GET', 'POST'])
+# Each open stream occupies its worker for as long as the page is open, which
+# only async workers (or the threaded dev server) can afford
+def live_updates_supported():
+    if Config.LIVE_UPDATES != 'auto':
+        return Config.LIVE_UPDATES == 'on'
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('socket'):
+        return True
+    return request.environ.get('SERVER_SOFTWARE', '').startswith('Werkzeug')
+
+@bp.route('/events/stream')
+def events_stream():
+    # Server-sent events with availability deltas for every event.
+    # 204 tells the browser to stop reconnecting; the page keeps the counts
+    # it was rendered with.
+    if not live_updates_supported():
+        return Response(status=204)
+    
+    ensure_availability_listener()
+    return Response(availability_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         first_name = request.form.get('first_name')
@@ -269,7 +1717,7 @@ def register():
                 print(f"User registered successfully with ID: {user_id}")
                 
                 flash("Registration successful! Please login.", "success")
-                return redirect(url_for('login'))
+                return redirect(url_for('.login'))
         except Exception as e:
             conn.rollback()
             flash(f"Registration error: {e}", "error")
@@ -279,7 +1727,7 @@ def register():
     
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form.get('email')
@@ -323,9 +1771,9 @@ def login():
                 session['is_admin'] = user['is_admin']
                 
                 if user['is_admin']:
-                    return redirect(url_for('admin_dashboard'))
+                    return redirect(url_for('.admin_dashboard'))
                 else:
-                    return redirect(url_for('user_dashboard'))
+                    return redirect(url_for('.user_dashboard'))
         except Exception as e:
             flash(f"Login error: {e}", "error")
             return render_template('login.html')
@@ -334,38 +1782,44 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
-@app.route('/user_dashboard')
+@bp.route('/user_dashboard')
+@query_budget(4)
 def user_dashboard():
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     if session.get('is_admin'):
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             # Get user info
             cur.execute("""
-                SELECT id, first_name, last_name, email, phone
+                SELECT id, first_name, last_name, email, phone, version
                 FROM users WHERE id = %s
             """, (session['user_id'],))
             
             user = cur.fetchone()
             
-            # Get user bookings
+            # Get user bookings; the cancellation deadline is stored with each
+            # booking (epoch seconds for the countdown), and the card's Cancel
+            # button disables itself once it has passed
             cur.execute("""
                 SELECT b.id, e.name as event_name, b.num_tickets, b.total_price,
-                       b.booking_date, e.date as event_date, e.venue as event_venue
+                       b.booking_date, e.date as event_date, e.venue as event_venue,
+                       b.cancellation_open,
+                       EXTRACT(EPOCH FROM b.cancellable_until::timestamptz) as cancellation_deadline,
+                       b.xmin::text || ':' || e.version::text as row_version
                 FROM bookings b
                 JOIN events e ON b.event_id = e.id
                 WHERE b.user_id = %s AND b.status = 'active'
@@ -374,25 +1828,40 @@ def user_dashboard():
             
             bookings = cur.fetchall()
             
+            # Get waitlist entries that are still pending
+            cur.execute("""
+                SELECT w.id, e.name as event_name, e.date as event_date, w.num_tickets,
+                       w.status, w.claim_expires_at, e.price * w.num_tickets as total_price
+                FROM waitlist_entries w
+                JOIN events e ON w.event_id = e.id
+                WHERE w.user_id = %s AND w.status IN ('waiting', 'offered')
+                ORDER BY w.id
+            """, (session['user_id'],))
+            
+            waitlist = cur.fetchall()
+            
             return render_template('user_dashboard.html', 
                                   user=user, 
                                   user_name=session['user_name'],
-                                  bookings=bookings)
+                                  bookings=bookings,
+                                  booking_cards=render_fragments('booking_card', bookings),
+                                  waitlist=waitlist)
     except Exception as e:
         flash(f"Error loading dashboard: {e}", "error")
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     finally:
         conn.close()
 
-@app.route('/admin_dashboard')
+@bp.route('/admin_dashboard')
+@query_budget(6)
 def admin_dashboard():
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     
     try:
         print("Fetching admin dashboard data...")
@@ -408,9 +1877,17 @@ def admin_dashboard():
             # Get all events
             cur.execute("""
                 SELECT e.id, e.name, e.date, e.venue, e.price, e.available_tickets,
-                       e.status, e.description, a.name as artistname
+                       e.status, e.description, e.version, a.name as artistname,
+                       e.max_tickets_per_booking, e.max_tickets_per_user,
+                       e.cancellation_window_hours,
+                       j.status as cancellation_status,
+                       j.processed_count as cancellation_processed,
+                       j.total_count as cancellation_total,
+                       e.xmin::text || ':' || a.xmin::text || ':' ||
+                       COALESCE(j.xmin::text, '') as row_version
                 FROM events e
                 JOIN artists a ON e.artist_id = a.id
+                LEFT JOIN event_cancellation_jobs j ON j.event_id = e.id
                 ORDER BY e.date DESC
             """)
             
@@ -432,7 +1909,8 @@ def admin_dashboard():
             cur.execute("""
                 SELECT b.id, u.first_name || ' ' || u.last_name as user_name,
                        e.name as event_name, b.num_tickets, b.total_price,
-                       b.status, b.booking_date, u.id as user_id
+                       b.status, b.booking_date, u.id as user_id,
+                       b.xmin::text || ':' || e.version::text || ':' || u.version::text as row_version
                 FROM bookings b
                 JOIN events e ON b.event_id = e.id
                 JOIN users u ON b.user_id = u.id
@@ -454,24 +1932,26 @@ def admin_dashboard():
             return render_template('admin_dashboard.html', 
                                   admin=admin,
                                   events=events,
+                                  event_rows=render_fragments('event_row', events),
                                   users=users,
                                   bookings=bookings,
+                                  booking_rows=render_fragments('booking_row', bookings),
                                   contact_submissions=contact_submissions)
     except Exception as e:
         flash(f"Error loading admin dashboard: {e}", "error")
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     finally:
         conn.close()
 
-@app.route('/mark_contact_read/<int:submission_id>', methods=['POST'])
+@bp.route('/mark_contact_read/<int:submission_id>', methods=['POST'])
 def mark_contact_read(submission_id):
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
     try:
         with conn.cursor() as cur:
@@ -482,25 +1962,26 @@ def mark_contact_read(submission_id):
                 WHERE id = %s
             """, (submission_id,))
             
-            conn.commit()
+            audit('contact_marked_read', 'contact', submission_id)
+            commit(conn)
             flash("Contact submission marked as read", "success")
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error updating contact submission: {e}", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     finally:
         conn.close()
 
-@app.route('/delete_contact/<int:submission_id>', methods=['POST'])
+@bp.route('/delete_contact/<int:submission_id>', methods=['POST'])
 def delete_contact(submission_id):
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
     try:
         with conn.cursor() as cur:
@@ -510,56 +1991,92 @@ def delete_contact(submission_id):
                 WHERE id = %s
             """, (submission_id,))
             
-            conn.commit()
+            audit('contact_deleted', 'contact', submission_id)
+            commit(conn)
             flash("Contact submission deleted", "success")
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error deleting contact submission: {e}", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     finally:
         conn.close()
 
-@app.route('/booking', methods=['GET', 'POST'])
+@bp.route('/booking', methods=['GET', 'POST'])
+@query_budget(10)
 def booking():
     if 'user_id' not in session:
         flash("Please login to book tickets", "error")
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     if request.method == 'POST':
         event_id = request.form.get('event')
         name = request.form.get('name')
         email = request.form.get('email')
         phone = request.form.get('phone')
-        num_tickets = int(request.form.get('tickets', 1))
         payment_method = request.form.get('payment_method')
+        try:
+            num_tickets = int(request.form.get('tickets', 1))
+        except ValueError:
+            num_tickets = 0
         
         if not all([event_id, name, email, phone, payment_method]):
             flash("Please fill all required fields", "error")
-            return redirect(url_for('booking'))
+            return redirect(url_for('.booking'))
+        
+        if num_tickets < 1:
+            flash("Please enter a valid number of tickets", "error")
+            return redirect(url_for('.booking'))
         
         conn = get_db_connection()
         if not conn:
             flash("Database connection error", "error")
-            return redirect(url_for('booking'))
+            return redirect(url_for('.booking'))
         
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Get event details
+                if not check_booking_velocity(conn, session['user_id']):
+                    flash("Too many bookings in a short time. Please wait a minute and try again.", "error")
+                    return redirect(url_for('.booking'))
+                
+                # Reserve the tickets; the conditions make overselling and
+                # oversized bookings impossible even under concurrent requests
                 cur.execute("""
-                    SELECT id, name, price, available_tickets
-                    FROM events WHERE id = %s
-                """, (event_id,))
+                    UPDATE events
+                    SET available_tickets = available_tickets - %s
+                    WHERE id = %s AND status = 'active' AND date >= CURRENT_DATE
+                      AND available_tickets >= %s
+                      AND %s <= COALESCE(max_tickets_per_booking, %s)
+                    RETURNING price, COALESCE(max_tickets_per_user, %s) as user_limit,
+                              LEAST(CURRENT_TIMESTAMP + make_interval(hours => COALESCE(cancellation_window_hours, %s)),
+                                    date::timestamp) as cancellable_until
+                """, (num_tickets, event_id, num_tickets, num_tickets,
+                      Config.DEFAULT_MAX_TICKETS_PER_BOOKING, Config.DEFAULT_MAX_TICKETS_PER_USER,
+                      Config.DEFAULT_CANCELLATION_WINDOW_HOURS))
                 
                 event = cur.fetchone()
                 if not event:
-                    flash("Event not found", "error")
-                    return redirect(url_for('booking'))
+                    rollback(conn)
+                    cur.execute("""
+                        SELECT available_tickets, COALESCE(max_tickets_per_booking, %s) as booking_limit
+                        FROM events
+                        WHERE id = %s AND status = 'active' AND date >= CURRENT_DATE
+                    """, (Config.DEFAULT_MAX_TICKETS_PER_BOOKING, event_id))
+                    
+                    event = cur.fetchone()
+                    if not event:
+                        flash("Event not found", "error")
+                    elif num_tickets > event['booking_limit']:
+                        flash(f"You can book at most {event['booking_limit']} tickets at a time", "error")
+                    else:
+                        flash(f"Only {event['available_tickets']} tickets available", "error")
+                    return redirect(url_for('.booking'))
                 
-                # Check ticket availability
-                if event['available_tickets'] < num_tickets:
-                    flash(f"Only {event['available_tickets']} tickets available", "error")
-                    return redirect(url_for('booking'))
+                if not reserve_user_tickets(cur, session['user_id'], event_id,
+                                            num_tickets, event['user_limit']):
+                    rollback(conn)
+                    flash(f"You can book at most {event['user_limit']} tickets for this event", "error")
+                    return redirect(url_for('.booking'))
                 
                 # Calculate total price
                 total_price = event['price'] * num_tickets
@@ -568,39 +2085,34 @@ def booking():
                 cur.execute("""
                     INSERT INTO bookings (
                         user_id, event_id, num_tickets, total_price, 
-                        status, booking_date, payment_method
+                        status, booking_date, payment_method, cancellable_until
                     )
-                    VALUES (%s, %s, %s, %s, %s, CURRENT_DATE, %s)
+                    VALUES (%s, %s, %s, %s, %s, CURRENT_DATE, %s, %s)
                     RETURNING id
                 """, (
                     session['user_id'], event_id, num_tickets, 
-                    total_price, 'active', payment_method
+                    total_price, 'active', payment_method, event['cancellable_until']
                 ))
                 
                 booking_id = cur.fetchone()['id']
                 
-                # Update available tickets
-                cur.execute("""
-                    UPDATE events
-                    SET available_tickets = available_tickets - %s
-                    WHERE id = %s
-                """, (num_tickets, event_id))
-                
-                conn.commit()
+                audit('booking_created', 'booking', booking_id, int(event_id), -num_tickets,
+                      total_price=total_price, payment_method=payment_method)
+                commit(conn)
                 flash("Booking successful!", "success")
-                return redirect(url_for('user_dashboard'))
+                return redirect(url_for('.user_dashboard'))
         except Exception as e:
-            conn.rollback()
+            rollback(conn)
             flash(f"Booking error: {e}", "error")
-            return redirect(url_for('booking'))
+            return redirect(url_for('.booking'))
         finally:
             conn.close()
     
     # GET request - show booking form
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     if not conn:
         flash("Database connection error", "error")
-        return render_template('booking.html', events=[], user=None)
+        return render_template('booking.html', events=[], sold_out_events=[], user=None)
     
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -612,50 +2124,60 @@ def booking():
             
             user = cur.fetchone()
             
-            # Get available events
+            # Get upcoming events, sold-out ones are offered a waitlist
             cur.execute("""
-                SELECT id, name, date, venue, price, available_tickets
+                SELECT id, name, date, venue, price, available_tickets,
+                       COALESCE(max_tickets_per_booking, %s) as booking_limit
                 FROM events
-                WHERE date >= CURRENT_DATE AND status = 'active' AND available_tickets > 0
+                WHERE date >= CURRENT_DATE AND status = 'active'
                 ORDER BY date
-            """)
+            """, (Config.DEFAULT_MAX_TICKETS_PER_BOOKING,))
             
-            events = cur.fetchall()
-            print(f"Found {len(events) if events else 0} available events for booking")
+            upcoming = cur.fetchall()
+            events = [event for event in upcoming if event['available_tickets'] > 0]
+            sold_out_events = [event for event in upcoming if event['available_tickets'] <= 0]
+            print(f"Found {len(events)} available events for booking")
             
             if not events:
                 flash("No upcoming events available for booking at this time.", "info")
             
-            return render_template('booking.html', events=events, user=user)
+            return render_template('booking.html', events=events,
+                                   sold_out_events=sold_out_events, user=user)
     except Exception as e:
         flash(f"Error loading booking page: {e}", "error")
-        return render_template('booking.html', events=[], user=None)
+        return render_template('booking.html', events=[], sold_out_events=[], user=None)
     finally:
         conn.close()
 
-@app.route('/cancel_ticket/<int:booking_id>', methods=['POST'])
+@bp.route('/cancel_ticket/<int:booking_id>', methods=['POST'])
 def cancel_ticket(booking_id):
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('user_dashboard'))
+        return redirect(url_for('.user_dashboard'))
     
     try:
         with conn.cursor() as cur:
             # Check if booking belongs to user
             cur.execute("""
-                SELECT event_id, num_tickets, user_id
+                SELECT event_id, num_tickets, user_id, status,
+                       cancellation_open AND cancellable_until > CURRENT_TIMESTAMP
                 FROM bookings
                 WHERE id = %s
+                FOR UPDATE
             """, (booking_id,))
             
             booking = cur.fetchone()
-            if not booking or booking[2] != session['user_id']:
+            if not booking or booking[2] != session['user_id'] or booking[3] != 'active':
                 flash("Invalid booking", "error")
-                return redirect(url_for('user_dashboard'))
+                return redirect(url_for('.user_dashboard'))
+            
+            if not booking[4]:
+                flash("The cancellation period for this booking has ended", "error")
+                return redirect(url_for('.user_dashboard'))
             
             # Update booking status
             cur.execute("""
@@ -671,20 +2193,231 @@ def cancel_ticket(booking_id):
                 WHERE id = %s
             """, (booking[1], booking[0]))
             
-            conn.commit()
+            release_user_tickets(cur, session['user_id'], booking[0], booking[1])
+            
+            audit('booking_cancelled', 'booking', booking_id, booking[0], booking[1])
+            
+            # Offer the released tickets to the waitlist
+            promote_waitlist(conn, booking[0])
+            
+            commit(conn)
             flash("Booking cancelled successfully", "success")
-            return redirect(url_for('user_dashboard'))
+            return redirect(url_for('.user_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error cancelling booking: {e}", "error")
-        return redirect(url_for('user_dashboard'))
+        return redirect(url_for('.user_dashboard'))
+    finally:
+        conn.close()
+
+@bp.route('/join_waitlist', methods=['POST'])
+def join_waitlist():
+    if 'user_id' not in session:
+        flash("Please login to join a waitlist", "error")
+        return redirect(url_for('.login'))
+    
+    event_id = request.form.get('event')
+    try:
+        num_tickets = int(request.form.get('tickets', 1))
+    except ValueError:
+        num_tickets = 0
+    
+    if not event_id or num_tickets < 1:
+        flash("Please select an event and a valid number of tickets", "error")
+        return redirect(url_for('.booking'))
+    
+    conn = get_db_connection()
+    if not conn:
+        flash("Database connection error", "error")
+        return redirect(url_for('.booking'))
+    
+    try:
+        with conn.cursor() as cur:
+            # Joining counts towards the booking rate limit, since an offer holds tickets
+            if not check_booking_velocity(conn, session['user_id']):
+                flash("Too many bookings in a short time. Please wait a minute and try again.", "error")
+                return redirect(url_for('.booking'))
+            
+            cur.execute("""
+                SELECT e.available_tickets, COALESCE(e.max_tickets_per_booking, %s),
+                       COALESCE(e.max_tickets_per_user, %s), COALESCE(t.tickets, 0)
+                FROM events e
+                LEFT JOIN user_event_tickets t ON t.event_id = e.id AND t.user_id = %s
+                WHERE e.id = %s AND e.status = 'active' AND e.date >= CURRENT_DATE
+            """, (Config.DEFAULT_MAX_TICKETS_PER_BOOKING, Config.DEFAULT_MAX_TICKETS_PER_USER,
+                  session['user_id'], event_id))
+            
+            event = cur.fetchone()
+            if not event:
+                rollback(conn)
+                flash("Event not found", "error")
+                return redirect(url_for('.booking'))
+            
+            available, booking_limit, user_limit, user_tickets = event
+            if available > 0:
+                rollback(conn)
+                flash("This event still has tickets available, please book them directly", "error")
+                return redirect(url_for('.booking'))
+            
+            if num_tickets > booking_limit:
+                rollback(conn)
+                flash(f"You can book at most {booking_limit} tickets at a time", "error")
+                return redirect(url_for('.booking'))
+            
+            if user_tickets + num_tickets > user_limit:
+                rollback(conn)
+                flash(f"You can book at most {user_limit} tickets for this event", "error")
+                return redirect(url_for('.booking'))
+            
+            # One pending entry per user and event
+            cur.execute("""
+                SELECT id FROM waitlist_entries
+                WHERE user_id = %s AND event_id = %s AND status IN ('waiting', 'offered')
+            """, (session['user_id'], event_id))
+            
+            if cur.fetchone():
+                rollback(conn)
+                flash("You are already on the waitlist for this event", "error")
+                return redirect(url_for('.user_dashboard'))
+            
+            cur.execute("""
+                INSERT INTO waitlist_entries (event_id, user_id, num_tickets)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            """, (event_id, session['user_id'], num_tickets))
+            
+            audit('waitlist_joined', 'waitlist', cur.fetchone()[0], int(event_id),
+                  num_tickets=num_tickets)
+            
+            # Tickets may have been released since the page was loaded
+            promote_waitlist(conn, event_id)
+            
+            commit(conn)
+            flash("You have joined the waitlist", "success")
+            return redirect(url_for('.user_dashboard'))
+    except Exception as e:
+        rollback(conn)
+        flash(f"Error joining waitlist: {e}", "error")
+        return redirect(url_for('.booking'))
+    finally:
+        conn.close()
+
+@bp.route('/claim_waitlist/<int:entry_id>', methods=['POST'])
+def claim_waitlist(entry_id):
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+    
+    payment_method = request.form.get('payment_method')
+    if not payment_method:
+        flash("Please select a payment method", "error")
+        return redirect(url_for('.user_dashboard'))
+    
+    conn = get_db_connection()
+    if not conn:
+        flash("Database connection error", "error")
+        return redirect(url_for('.user_dashboard'))
+    
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT w.id, w.event_id, w.num_tickets, e.price,
+                       COALESCE(e.max_tickets_per_user, %s) as user_limit,
+                       LEAST(CURRENT_TIMESTAMP + make_interval(hours => COALESCE(e.cancellation_window_hours, %s)),
+                             e.date::timestamp) as cancellable_until
+                FROM waitlist_entries w
+                JOIN events e ON w.event_id = e.id
+                WHERE w.id = %s AND w.user_id = %s AND w.status = 'offered'
+                  AND w.claim_expires_at >= CURRENT_TIMESTAMP AND e.status = 'active'
+                FOR UPDATE OF w
+            """, (Config.DEFAULT_MAX_TICKETS_PER_USER, Config.DEFAULT_CANCELLATION_WINDOW_HOURS,
+                  entry_id, session['user_id']))
+            
+            entry = cur.fetchone()
+            if not entry:
+                flash("This offer is no longer available", "error")
+                return redirect(url_for('.user_dashboard'))
+            
+            if not reserve_user_tickets(cur, session['user_id'], entry['event_id'],
+                                        entry['num_tickets'], entry['user_limit']):
+                rollback(conn)
+                flash(f"You can book at most {entry['user_limit']} tickets for this event", "error")
+                return redirect(url_for('.user_dashboard'))
+            
+            # Tickets were held when the offer was made, so only the booking is created
+            cur.execute("""
+                INSERT INTO bookings (
+                    user_id, event_id, num_tickets, total_price,
+                    status, booking_date, payment_method, cancellable_until
+                )
+                VALUES (%s, %s, %s, %s, %s, CURRENT_DATE, %s, %s)
+                RETURNING id
+            """, (
+                session['user_id'], entry['event_id'], entry['num_tickets'],
+                entry['price'] * entry['num_tickets'], 'active', payment_method,
+                entry['cancellable_until']
+            ))
+            
+            # The tickets left the pool when they were offered, so no delta here
+            audit('booking_created', 'booking', cur.fetchone()['id'], entry['event_id'],
+                  waitlist_entry=entry_id, num_tickets=entry['num_tickets'])
+            
+            cur.execute("""
+                UPDATE waitlist_entries
+                SET status = 'claimed'
+                WHERE id = %s
+            """, (entry_id,))
+            
+            commit(conn)
+            flash("Booking successful!", "success")
+            return redirect(url_for('.user_dashboard'))
+    except Exception as e:
+        rollback(conn)
+        flash(f"Error claiming tickets: {e}", "error")
+        return redirect(url_for('.user_dashboard'))
+    finally:
+        conn.close()
+
+@bp.route('/leave_waitlist/<int:entry_id>', methods=['POST'])
+def leave_waitlist_entry(entry_id):
+    if 'user_id' not in session:
+        return redirect(url_for('.login'))
+    
+    conn = get_db_connection()
+    if not conn:
+        flash("Database connection error", "error")
+        return redirect(url_for('.user_dashboard'))
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT event_id FROM waitlist_entries
+                WHERE id = %s AND user_id = %s AND status IN ('waiting', 'offered')
+            """, (entry_id, session['user_id']))
+            
+            entry = cur.fetchone()
+            if not entry:
+                flash("You are no longer on this waitlist", "error")
+                return redirect(url_for('.user_dashboard'))
+        
+        if not leave_waitlist(conn, entry[0], session['user_id']):
+            rollback(conn)
+            flash("You are no longer on this waitlist", "error")
+            return redirect(url_for('.user_dashboard'))
+        
+        commit(conn)
+        flash("You have left the waitlist", "success")
+        return redirect(url_for('.user_dashboard'))
+    except Exception as e:
+        rollback(conn)
+        flash(f"Error leaving waitlist: {e}", "error")
+        return redirect(url_for('.user_dashboard'))
     finally:
         conn.close()
 
-@app.route('/add_event', methods=['POST'])
+@bp.route('/add_event', methods=['POST'])
 def add_event():
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     name = request.form.get('name')
     date = request.form.get('date')
@@ -697,12 +2430,20 @@ def add_event():
     
     if not all([name, date, venue, price, available_tickets]):
         flash("Please fill all required fields", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
+    
+    try:
+        max_per_booking = parse_ticket_limit(request.form.get('max_tickets_per_booking'))
+        max_per_user = parse_ticket_limit(request.form.get('max_tickets_per_user'))
+        cancellation_window = parse_cancellation_window(request.form.get('cancellation_window_hours'))
+    except ValueError:
+        flash("Ticket limits and cancellation window must be valid numbers", "error")
+        return redirect(url_for('.admin_dashboard'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
     try:
         print(f"Adding new event: {name} on {date} at {venue}")
@@ -713,7 +2454,7 @@ def add_event():
             if not artist_result:
                 print("No artists found in database")
                 flash("No artists found", "error")
-                return redirect(url_for('admin_dashboard'))
+                return redirect(url_for('.admin_dashboard'))
             
             artist_id = artist_result[0]
             print(f"Using artist ID: {artist_id}")
@@ -722,81 +2463,167 @@ def add_event():
             cur.execute("""
                 INSERT INTO events (
                     name, date, venue, price, available_tickets,
-                    description, artist_id, status
+                    description, artist_id, status,
+                    max_tickets_per_booking, max_tickets_per_user, cancellation_window_hours
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING id
             """, (
                 name, date, venue, price, available_tickets,
-                description, artist_id, 'active'
+                description, artist_id, 'active',
+                max_per_booking, max_per_user, cancellation_window
             ))
             
             new_event_id = cur.fetchone()[0]
-            conn.commit()
+            audit('event_created', 'event', new_event_id, new_event_id, int(available_tickets),
+                  name=name, date=date, venue=venue, price=price)
+            commit(conn)
             print(f"Event added successfully with ID: {new_event_id}")
             flash("Event added successfully", "success")
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         print(f"Error adding event: {e}")
         flash(f"Error adding event: {e}", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     finally:
         conn.close()
 
-@app.route('/edit_event/<int:event_id>', methods=['POST'])
+@bp.route('/edit_event/<int:event_id>', methods=['POST'])
 def edit_event(event_id):
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     name = request.form.get('name')
     date = request.form.get('date')
     venue = request.form.get('venue')
     price = request.form.get('price')
-    available_tickets = request.form.get('available_tickets')
     description = request.form.get('description')
     
-    if not all([name, date, venue, price, available_tickets]):
+    if not all([name, date, venue, price, request.form.get('version')]):
         flash("Please fill all required fields", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
+    
+    try:
+        date = datetime.strptime(date, '%Y-%m-%d').date()
+        price = Decimal(price)
+        version = int(request.form.get('version'))
+        # Capacity is changed by a delta so tickets sold meanwhile are kept
+        ticket_change = int(request.form.get('ticket_change') or 0)
+        max_per_booking = parse_ticket_limit(request.form.get('max_tickets_per_booking'))
+        max_per_user = parse_ticket_limit(request.form.get('max_tickets_per_user'))
+        cancellation_window = parse_cancellation_window(request.form.get('cancellation_window_hours'))
+    except (ValueError, InvalidOperation):
+        flash("Invalid event details", "error")
+        return redirect(url_for('.admin_dashboard'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
     try:
-        with conn.cursor() as cur:
-            # Update event
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("""
-                UPDATE events
-                SET name = %s, date = %s, venue = %s, price = %s,
-                    available_tickets = %s, description = %s
-                WHERE id = %s
-            """, (
-                name, date, venue, price, available_tickets,
-                description, event_id
-            ))
+                SELECT name, date, venue, price, description, available_tickets, version,
+                       max_tickets_per_booking, max_tickets_per_user, cancellation_window_hours,
+                       waitlist_held_tickets
+                FROM events WHERE id = %s
+                FOR UPDATE
+            """, (event_id,))
             
-            conn.commit()
+            event = cur.fetchone()
+            if not event:
+                flash("Event not found", "error")
+                return redirect(url_for('.admin_dashboard'))
+            
+            changes = changed_columns(event, {
+                'name': name, 'date': date, 'venue': venue,
+                'price': price, 'description': description,
+                'max_tickets_per_booking': max_per_booking,
+                'max_tickets_per_user': max_per_user,
+                'cancellation_window_hours': cancellation_window
+            })
+            
+            if changes and event['version'] != version:
+                flash("This event was changed by someone else. Please review it and try again.", "error")
+                return redirect(url_for('.admin_dashboard'))
+            
+            if not changes and ticket_change == 0:
+                flash("No changes to save", "info")
+                return redirect(url_for('.admin_dashboard'))
+            
+            # A reduction comes out of public tickets first, then out of any
+            # held for the waitlist
+            from_held = max(-(event['available_tickets'] + ticket_change), 0)
+            if from_held > event['waitlist_held_tickets']:
+                rollback(conn)
+                flash("Cannot remove more tickets than are still unsold", "error")
+                return redirect(url_for('.admin_dashboard'))
+            available_change = ticket_change + from_held
+            
+            # Only write the columns that changed; the version check guards
+            # descriptive fields, the capacity delta never drops below zero
+            extra = ['available_tickets = available_tickets + %s']
+            params = list(changes.values()) + [available_change]
+            if from_held:
+                extra.append('waitlist_held_tickets = waitlist_held_tickets - %s')
+                params.append(from_held)
+            params += [event_id, available_change]
+            condition = sql.SQL('id = %s AND available_tickets + %s >= 0')
+            if changes:
+                extra.append('version = version + 1')
+                condition = sql.SQL('{} AND version = %s').format(condition)
+                params.append(version)
+            
+            cur.execute(sql.SQL("UPDATE events SET {} WHERE {} RETURNING id").format(
+                set_clause(changes, *extra), condition), params)
+            
+            if not cur.fetchone():
+                rollback(conn)
+                if changes:
+                    flash("This event was changed by someone else. Please review it and try again.", "error")
+                else:
+                    flash("Cannot remove more tickets than are still unsold", "error")
+                return redirect(url_for('.admin_dashboard'))
+            
+            if from_held:
+                changes['waitlist_held_removed'] = from_held
+            audit('event_updated', 'event', event_id, event_id, available_change, **changes)
+            
+            # Windows are fixed when a booking is made, but none may outlast
+            # the event; a later date doesn't extend them
+            if 'date' in changes:
+                cur.execute("""
+                    UPDATE bookings
+                    SET cancellable_until = LEAST(cancellable_until, %s::timestamp)
+                    WHERE event_id = %s AND status = 'active' AND cancellation_open
+                      AND cancellable_until > %s::timestamp
+                """, (date, event_id, date))
+            
+            # Added capacity goes to the waitlist first
+            if ticket_change > 0:
+                promote_waitlist(conn, event_id)
+            
+            commit(conn)
             flash("Event updated successfully", "success")
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error updating event: {e}", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     finally:
         conn.close()
 
-@app.route('/delete_event/<int:event_id>', methods=['POST'])
+@bp.route('/delete_event/<int:event_id>', methods=['POST'])
 def delete_event(event_id):
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
     try:
         with conn.cursor() as cur:
@@ -807,25 +2634,52 @@ def delete_event(event_id):
                 WHERE id = %s
             """, (event_id,))
             
-            conn.commit()
-            flash("Event cancelled successfully", "success")
-            return redirect(url_for('admin_dashboard'))
+            # Record a cancellation job so refunds can resume after a crash
+            cur.execute("""
+                INSERT INTO event_cancellation_jobs (event_id, total_count)
+                SELECT %s, COUNT(*) FROM bookings
+                WHERE event_id = %s AND status = 'active'
+                ON CONFLICT (event_id) DO UPDATE
+                SET status = 'running', updated_at = CURRENT_TIMESTAMP,
+                    total_count = event_cancellation_jobs.processed_count + EXCLUDED.total_count,
+                    completed_at = NULL
+                RETURNING total_count
+            """, (event_id, event_id))
+            
+            total_count = cur.fetchone()[0]
+            
+            # Nobody can claim tickets for a cancelled event
+            cur.execute("""
+                UPDATE waitlist_entries
+                SET status = 'cancelled'
+                WHERE event_id = %s AND status IN ('waiting', 'offered')
+            """, (event_id,))
+            
+            audit('event_cancelled', 'event', event_id, event_id, bookings=total_count)
+            commit(conn)
+            
+            # Refund and notify affected bookings in the background
+            threading.Thread(target=process_event_cancellation,
+                             args=(event_id,), daemon=True).start()
+            
+            flash(f"Event cancelled successfully. Refunding {total_count} bookings.", "success")
+            return redirect(url_for('.admin_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error cancelling event: {e}", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     finally:
         conn.close()
 
-@app.route('/delete_user/<int:user_id>', methods=['POST'])
+@bp.route('/delete_user/<int:user_id>', methods=['POST'])
 def delete_user(user_id):
     if 'user_id' not in session or not session.get('is_admin'):
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     
     try:
         with conn.cursor() as cur:
@@ -838,9 +2692,29 @@ def delete_user(user_id):
             active_bookings = cur.fetchone()[0]
             if active_bookings > 0:
                 flash("Cannot delete user with active bookings", "error")
-                return redirect(url_for('admin_dashboard'))
+                return redirect(url_for('.admin_dashboard'))
+            
+            # Leave any waitlists (returning offered tickets to the queue), then
+            # drop the user's waitlist history
+            cur.execute("""
+                SELECT DISTINCT event_id FROM waitlist_entries
+                WHERE user_id = %s AND status IN ('waiting', 'offered')
+            """, (user_id,))
             
-            # Delete all cancelled bookings for this user
+            for (event_id,) in cur.fetchall():
+                leave_waitlist(conn, event_id, user_id)
+            
+            cur.execute("DELETE FROM waitlist_entries WHERE user_id = %s", (user_id,))
+            
+            # Messages that can no longer be delivered are dropped from the outbox
+            cur.execute("""
+                UPDATE notifications
+                SET status = 'cancelled'
+                WHERE user_id = %s AND status = 'pending'
+            """, (user_id,))
+            
+            # Delete all cancelled bookings for this user. Refunds and sent
+            # notifications are kept, with their user and booking set to NULL
             cur.execute("""
                 DELETE FROM bookings
                 WHERE user_id = %s AND status = 'cancelled'
@@ -849,20 +2723,21 @@ def delete_user(user_id):
             # Delete user
             cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
             
-            conn.commit()
+            audit('user_deleted', 'user', user_id)
+            commit(conn)
             flash("User deleted successfully", "success")
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
     except Exception as e:
-        conn.rollback()
+        rollback(conn)
         flash(f"Error deleting user: {e}", "error")
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     finally:
         conn.close()
 
-@app.route('/update_profile', methods=['POST'])
+@bp.route('/update_profile', methods=['POST'])
 def update_profile():
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     first_name = request.form.get('first_name')
     last_name = request.form.get('last_name')
@@ -874,48 +2749,64 @@ def update_profile():
     
     if not all([first_name, last_name, email]):
         flash("Please fill all required fields", "error")
-        return redirect(url_for('user_dashboard'))
+        return redirect(url_for('.user_dashboard'))
+    
+    try:
+        version = int(request.form.get('version', ''))
+    except ValueError:
+        flash("Please reload the page and try again", "error")
+        return redirect(url_for('.user_dashboard'))
     
     conn = get_db_connection()
     if not conn:
         flash("Database connection error", "error")
-        return redirect(url_for('user_dashboard'))
+        return redirect(url_for('.user_dashboard'))
     
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             # Get current user data
             cur.execute("""
-                SELECT password
+                SELECT first_name, last_name, email, phone, password, version
                 FROM users WHERE id = %s
             """, (session['user_id'],))
             
             user = cur.fetchone()
             
-            # Update basic info
-            cur.execute("""
-                UPDATE users
-                SET first_name = %s, last_name = %s, email = %s, phone = %s
-                WHERE id = %s
-            """, (
-                first_name, last_name, email, phone, session['user_id']
-            ))
+            changes = changed_columns(user, {
+                'first_name': first_name, 'last_name': last_name,
+                'email': email, 'phone': phone
+            })
             
             # Update password if provided
             if current_password and new_password and confirm_password:
                 if new_password != confirm_password:
                     flash("New passwords do not match", "error")
-                    return redirect(url_for('user_dashboard'))
+                    return redirect(url_for('.user_dashboard'))
                 
                 if not check_password_hash(user['password'], current_password):
                     flash("Current password is incorrect", "error")
-                    return redirect(url_for('user_dashboard'))
+                    return redirect(url_for('.user_dashboard'))
                 
-                hashed_password = generate_password_hash(new_password)
-                cur.execute("""
-                    UPDATE users
-                    SET password = %s
-                    WHERE id = %s
-                """, (hashed_password, session['user_id']))
+                changes['password'] = generate_password_hash(new_password)
+            
+            if not changes:
+                flash("No changes to save", "info")
+                return redirect(url_for('.user_dashboard'))
+            
+            # Write only the changed columns, and only if nobody else has
+            # updated the profile since the form was loaded
+            cur.execute(sql.SQL("""
+                UPDATE users
+                SET {}
+                WHERE id = %s AND version = %s
+                RETURNING id
+            """).format(set_clause(changes, 'version = version + 1')),
+                list(changes.values()) + [session['user_id'], version])
+            
+            if not cur.fetchone():
+                conn.rollback()
+                flash("Your profile was changed in another session. Please review it and try again.", "error")
+                return redirect(url_for('.user_dashboard'))
             
             conn.commit()
             
@@ -923,20 +2814,35 @@ def update_profile():
             session['user_name'] = f"{first_name} {last_name}"
             
             flash("Profile updated successfully", "success")
-            return redirect(url_for('user_dashboard'))
+            return redirect(url_for('.user_dashboard'))
     except Exception as e:
         conn.rollback()
         flash(f"Error updating profile: {e}", "error")
-        return redirect(url_for('user_dashboard'))
+        return redirect(url_for('.user_dashboard'))
     finally:
         conn.close()
 
-if __name__ == '__main__':
-    # Initialize database
-    init_db()
+# Application factory. Only configures Flask, so it starts in milliseconds;
+# database connections are opened on first use by the request that needs one.
+# Run "flask --app app init-db" once to set up the schema.
+def create_app():
+    if Config.APP_ENV == 'production' and Config.SECRET_KEY == 'dev_secret_key':
+        raise RuntimeError("SECRET_KEY must be set when APP_ENV=production")
+    if Config.CACHE_URL and redis is None:
+        raise RuntimeError("CACHE_URL is set but the redis package is not installed")
     
-    # Create admin user
-    ensure_admin_exists()
+    app = Flask(__name__, 
+               static_folder='static',
+               template_folder='templates')
+    app.config.from_object(Config)
     
+    app.jinja_env.bytecode_cache = template_bytecode_cache(
+        Config.TEMPLATE_CACHE_DIR or os.path.join(app.instance_path, 'jinja_cache'))
+    
+    app.register_blueprint(bp)
+    warm_template_cache(app)
+    return app
+
+if __name__ == '__main__':
     # Run the app
-    app.run(debug=True)
+    create_app().run(debug=True)
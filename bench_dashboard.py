@@ -0,0 +1,58 @@
+# Measure admin dashboard render time with and without the row fragment cache.
+# No database is needed: rows are generated in memory.
+#
+#   python bench_dashboard.py [rows]
+import sys
+import time
+from datetime import date
+
+from flask import render_template
+
+from app import create_app, get_fragment_cache, render_fragments
+
+def make_rows(count):
+    events = [{
+        'id': i, 'name': f'Event {i}', 'date': date(2025, 1, 1), 'venue': 'Venue A',
+        'price': 50, 'available_tickets': 100, 'status': 'active',
+        'description': "Someone's event", 'artistname': 'The Band',
+        'cancellation_status': None, 'row_version': '1:1:'
+    } for i in range(count)]
+    bookings = [{
+        'id': i, 'user_name': 'Jane Smith', 'event_name': f'Event {i}', 'num_tickets': 2,
+        'total_price': 100, 'status': 'active', 'booking_date': date(2025, 1, 1),
+        'user_id': 1, 'row_version': '1:1:1'
+    } for i in range(count)]
+    return events, bookings
+
+def render(events, bookings):
+    return render_template('admin_dashboard.html',
+                           admin={'first_name': 'Admin', 'last_name': 'User'},
+                           events=events,
+                           event_rows=render_fragments('event_row', events),
+                           users=[],
+                           bookings=bookings,
+                           booking_rows=render_fragments('booking_row', bookings),
+                           contact_submissions=[])
+
+def timed(events, bookings, clear_cache, runs=5):
+    best = None
+    for _ in range(runs):
+        if clear_cache:
+            get_fragment_cache().clear()
+        start = time.perf_counter()
+        render(events, bookings)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    events, bookings = make_rows(count)
+    
+    with create_app().test_request_context('/admin_dashboard'):
+        cold = timed(events, bookings, clear_cache=True)
+        warm = timed(events, bookings, clear_cache=False)
+    
+    print(f"{count} events + {count} bookings")
+    print(f"uncached render: {cold * 1000:.1f} ms")
+    print(f"cached render:   {warm * 1000:.1f} ms ({cold / warm:.1f}x faster)")
@@ -0,0 +1,102 @@
+# Measure throughput scaling of the preforked server on /events and /booking.
+# Starts gunicorn with gunicorn.conf.py at 1, 2, 4 ... N workers, drives it
+# with keep-alive clients from separate processes and reports requests per
+# second and scaling efficiency against a single worker. Needs a populated
+# database and a regular user account for the /booking page:
+#
+#   BENCH_EMAIL=jane@example.com BENCH_PASSWORD=secret python bench_scaling.py [max_workers] [seconds]
+import http.client
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('BENCH_PORT', '8765'))
+PATHS = ['/events', '/booking']
+
+def start_server(workers):
+    env = dict(os.environ, BIND=f'{HOST}:{PORT}', WEB_CONCURRENCY=str(workers), ACCESS_LOG='/dev/null')
+    env.setdefault('APP_ENV', 'production')
+    env.setdefault('SECRET_KEY', 'bench_secret_key')
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(HOST, PORT, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            pass
+        time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not become healthy")
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    server.wait()
+
+def login():
+    conn = http.client.HTTPConnection(HOST, PORT)
+    body = urllib.parse.urlencode({
+        'email': os.environ['BENCH_EMAIL'],
+        'password': os.environ['BENCH_PASSWORD'],
+        'user_type': 'user'
+    })
+    conn.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie')
+    if response.status != 302 or not cookie:
+        raise RuntimeError("login failed, check BENCH_EMAIL and BENCH_PASSWORD")
+    return cookie.split(';', 1)[0]
+
+def client(path, cookie, seconds):
+    conn = http.client.HTTPConnection(HOST, PORT)
+    headers = {'Cookie': cookie}
+    count = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            count += 1
+    conn.close()
+    return count
+
+def measure(path, cookie, clients, seconds):
+    with ProcessPoolExecutor(clients) as pool:
+        counts = pool.map(client, [path] * clients, [cookie] * clients, [seconds] * clients)
+        return sum(counts) / seconds
+
+if __name__ == '__main__':
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    steps = []
+    workers = 1
+    while workers < max_workers:
+        steps.append(workers)
+        workers *= 2
+    steps.append(max_workers)
+
+    baseline = {}
+    print(f"{'path':<10} {'workers':>7} {'req/s':>10} {'efficiency':>10}")
+    for workers in steps:
+        server = start_server(workers)
+        try:
+            cookie = login()
+            for path in PATHS:
+                # Two clients per worker keeps every worker busy while one
+                # request is waiting on the database.
+                rate = measure(path, cookie, workers * 2, seconds)
+                baseline.setdefault(path, rate)
+                efficiency = rate / (baseline[path] * workers)
+                print(f"{path:<10} {workers:>7} {rate:>10.0f} {efficiency:>10.0%}")
+        finally:
+            stop_server(server)
@@ -0,0 +1,73 @@
+# Measure fan-out of live availability updates to many connected browsers.
+# Opens N server-sent event connections to /events/stream, sends one
+# availability NOTIFY through PostgreSQL and reports how long it took to
+# reach every client. Needs a running server that can hold N open streams,
+# e.g. gunicorn -k gevent -w 4 "app:create_app()", and "ulimit -n" above N.
+#
+#   python bench_sse.py [clients] [host] [port]
+import asyncio
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+async def open_stream(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET /events/stream HTTP/1.1\r\nHost: {host}\r\nAccept: text/event-stream\r\n\r\n".encode())
+    await writer.drain()
+    # Wait until the stream is established (headers plus the retry line)
+    while b'retry:' not in await reader.readline():
+        pass
+    return reader, writer
+
+async def wait_for_data(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line.startswith(b'data:'):
+            return time.perf_counter()
+
+def send_notify():
+    conn = psycopg2.connect(
+        dbname=os.environ.get('DB_NAME', 'event_booking'),
+        user=os.environ.get('DB_USER', 'postgres'),
+        password=os.environ.get('DB_PASSWORD', 'postgres'),
+        host=os.environ.get('DB_HOST', 'localhost'),
+        port=os.environ.get('DB_PORT', '5432')
+    )
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        payload = json.dumps({'id': 0, 'available_tickets': 0, 'status': 'benchmark'})
+        cur.execute("SELECT pg_notify('event_availability', %s)", (payload,))
+    conn.close()
+
+async def main(clients, host, port):
+    start = time.perf_counter()
+    streams = []
+    for offset in range(0, clients, 500):
+        batch = min(500, clients - offset)
+        streams += await asyncio.gather(*(open_stream(host, port) for _ in range(batch)))
+    print(f"{clients} clients connected in {time.perf_counter() - start:.1f}s")
+    
+    waiters = [asyncio.create_task(wait_for_data(reader)) for reader, _ in streams]
+    sent = time.perf_counter()
+    send_notify()
+    received = sorted(t - sent for t in await asyncio.gather(*waiters) if t)
+    
+    print(f"delivered to {len(received)}/{clients} clients")
+    if received:
+        print(f"p50 {received[len(received) // 2] * 1000:.0f} ms, "
+              f"p99 {received[int(len(received) * 0.99) - 1] * 1000:.0f} ms, "
+              f"max {received[-1] * 1000:.0f} ms")
+    
+    for _, writer in streams:
+        writer.close()
+
+if __name__ == '__main__':
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8000
+    asyncio.run(main(clients, host, port))
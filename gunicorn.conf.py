@@ -0,0 +1,45 @@
+# Production serving profile: a preforked pool of workers behind one socket.
+#
+#   APP_ENV=production SECRET_KEY=... gunicorn -c gunicorn.conf.py
+#
+# Send HUP to the master (kill -HUP <pid>) for a graceful reload: new workers
+# are started with fresh code and config, old ones finish in-flight requests
+# within graceful_timeout and exit.
+import multiprocessing
+import os
+
+# Open /events/stream connections and cooperative database calls need both;
+# without them a few open pages would tie up every worker, so refuse to start
+try:
+    import gevent  # noqa: F401
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    raise RuntimeError("gunicorn.conf.py needs gevent and psycogreen: pip install gevent psycogreen")
+
+wsgi_app = 'app:create_app()'
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+# gevent keeps many /events/stream connections open per worker
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', '1000'))
+
+# The app is loaded in each worker after fork so database connections, the
+# audit flusher and the availability listener are never shared between
+# processes.
+preload_app = False
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers periodically; jitter keeps them from restarting together.
+max_requests = int(os.environ.get('MAX_REQUESTS', '10000'))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+
+def post_fork(server, worker):
+    # Make psycopg2 cooperative under gevent so a slow query doesn't block the
+    # other greenlets in the worker
+    patch_psycopg()
@@ -1,4 +1,10 @@
 -- Drop tables if they exist
+DROP TABLE IF EXISTS user_event_tickets;
+DROP TABLE IF EXISTS audit_log;
+DROP TABLE IF EXISTS waitlist_entries;
+DROP TABLE IF EXISTS event_cancellation_jobs;
+DROP TABLE IF EXISTS notifications;
+DROP TABLE IF EXISTS refunds;
 DROP TABLE IF EXISTS bookings;
 DROP TABLE IF EXISTS events;
 DROP TABLE IF EXISTS artists;
@@ -13,6 +19,9 @@ CREATE TABLE users (
     phone VARCHAR(20),
     password VARCHAR(255) NOT NULL,
     is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+    version INTEGER NOT NULL DEFAULT 1,
+    booking_window_start TIMESTAMP,
+    booking_window_count INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -35,6 +44,12 @@ CREATE TABLE events (
     available_tickets INTEGER NOT NULL,
     artist_id INTEGER NOT NULL REFERENCES artists(id),
     status VARCHAR(20) NOT NULL DEFAULT 'active',
+    version INTEGER NOT NULL DEFAULT 1,
+    max_tickets_per_booking INTEGER,
+    max_tickets_per_user INTEGER,
+    cancellation_window_hours INTEGER,
+    -- Released tickets kept for people on the waitlist, off public sale
+    waitlist_held_tickets INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -48,9 +63,124 @@ CREATE TABLE bookings (
     status VARCHAR(20) NOT NULL DEFAULT 'active',
     booking_date DATE NOT NULL,
     payment_method VARCHAR(50) NOT NULL,
+    cancellable_until TIMESTAMP,
+    cancellation_open BOOLEAN NOT NULL DEFAULT TRUE,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX idx_bookings_event_status ON bookings (event_id, status, id);
+-- A user's active bookings (dashboard), and open cancellation windows by
+-- deadline for the closing job
+CREATE INDEX idx_bookings_user_active ON bookings (user_id, booking_date)
+    WHERE status = 'active';
+CREATE INDEX idx_bookings_cancellation_deadline ON bookings (cancellable_until)
+    WHERE status = 'active' AND cancellation_open;
+
+-- Running total of active tickets per user and event (purchase limits)
+CREATE TABLE user_event_tickets (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    event_id INTEGER NOT NULL REFERENCES events(id),
+    tickets INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, event_id)
+);
+
+-- Create refunds table (one refund per cancelled booking). Refunds outlive
+-- the user and booking they were for, which are set to NULL on deletion
+CREATE TABLE refunds (
+    id SERIAL PRIMARY KEY,
+    booking_id INTEGER UNIQUE REFERENCES bookings(id) ON DELETE SET NULL,
+    user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+    event_id INTEGER NOT NULL REFERENCES events(id),
+    amount DECIMAL(10, 2) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create notifications table (outbox of messages waiting to be sent)
+CREATE TABLE notifications (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+    event_id INTEGER REFERENCES events(id),
+    booking_id INTEGER REFERENCES bookings(id) ON DELETE SET NULL,
+    message TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_notifications_pending ON notifications (status, id);
+
+-- Create event cancellation jobs table (progress of bulk refunds per event)
+CREATE TABLE event_cancellation_jobs (
+    event_id INTEGER PRIMARY KEY REFERENCES events(id),
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    last_booking_id INTEGER NOT NULL DEFAULT 0,
+    processed_count INTEGER NOT NULL DEFAULT 0,
+    total_count INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP
+);
+
+-- Create waitlist table (FIFO queue per event, ordered by id)
+CREATE TABLE waitlist_entries (
+    id SERIAL PRIMARY KEY,
+    event_id INTEGER NOT NULL REFERENCES events(id),
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    num_tickets INTEGER NOT NULL CHECK (num_tickets > 0),
+    status VARCHAR(20) NOT NULL DEFAULT 'waiting',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    offered_at TIMESTAMP,
+    claim_expires_at TIMESTAMP
+);
+
+CREATE INDEX idx_waitlist_queue ON waitlist_entries (event_id, id) WHERE status = 'waiting';
+CREATE INDEX idx_waitlist_offers ON waitlist_entries (event_id, claim_expires_at) WHERE status = 'offered';
+CREATE INDEX idx_waitlist_user ON waitlist_entries (user_id, status);
+
+-- Notify listeners when an event's availability or status changes
+CREATE OR REPLACE FUNCTION notify_event_availability() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('event_availability', json_build_object(
+        'id', NEW.id,
+        'available_tickets', NEW.available_tickets,
+        'status', NEW.status
+    )::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER events_availability_notify
+AFTER UPDATE OF available_tickets, status ON events
+FOR EACH ROW
+WHEN (OLD.available_tickets IS DISTINCT FROM NEW.available_tickets
+      OR OLD.status IS DISTINCT FROM NEW.status)
+EXECUTE PROCEDURE notify_event_availability();
+
+-- Create audit log (append-only history of bookings and admin actions)
+CREATE TABLE audit_log (
+    id BIGSERIAL PRIMARY KEY,
+    occurred_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    actor_id INTEGER,
+    action VARCHAR(50) NOT NULL,
+    entity_type VARCHAR(20) NOT NULL,
+    entity_id INTEGER,
+    event_id INTEGER,
+    ticket_delta INTEGER NOT NULL DEFAULT 0,
+    details JSONB
+);
+
+CREATE INDEX idx_audit_log_event ON audit_log (event_id);
+
+CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'audit_log is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER audit_log_no_change
+BEFORE UPDATE OR DELETE ON audit_log
+FOR EACH ROW EXECUTE PROCEDURE audit_log_append_only();
+
 -- Insert sample data
 -- Insert sample artists
 INSERT INTO artists (name, description) VALUES
@@ -0,0 +1,217 @@
+# Tests for query profiling: QueryStats.repeated(), the @query_budget route
+# decorator, ProfilingCursor and the per-request hooks. Routes from
+# create_app() run against a stubbed get_db_connection() whose cursors are
+# ProfilingCursor subclasses over a fake cursor, so no database is needed.
+# The ProfiledConnection test runs against the database in Config (DB_HOST,
+# DB_NAME, ...) and is skipped when it can't connect.
+#
+# Run with: python -m pytest -q
+#
+# A test turns on strict budgets by patching Config (the app reads it on every
+# request), e.g. monkeypatch.setattr(app.Config, 'QUERY_BUDGET_STRICT', True),
+# or for a whole test run with QUERY_BUDGET_STRICT=1 in the environment.
+import psycopg2
+import pytest
+from flask import Flask, g
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+
+import app
+
+
+# Stands in for a psycopg2 cursor: each execute() returns the next canned
+# result (a list of rows)
+class FakeCursor:
+    def __init__(self, results):
+        self.results = results
+        self.rows = []
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query, vars=None):
+        self.rows = self.results.pop(0)
+        self.rowcount = len(self.rows)
+        self.description = [('column',)]
+
+    def executemany(self, query, vars_list):
+        self.rows = []
+        self.rowcount = len(vars_list)
+        self.description = None
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class FakeConnection:
+    def __init__(self, results):
+        self.results = results
+
+    def cursor(self, cursor_factory=None):
+        return app.profiled_cursor_class(FakeCursor)(self.results)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def flask_app(monkeypatch, tmp_path):
+    monkeypatch.setattr(app.Config, 'QUERY_PROFILING', True)
+    monkeypatch.setattr(app.Config, 'QUERY_BUDGET_STRICT', True)
+    monkeypatch.setattr(app.Config, 'TEMPLATE_CACHE_DIR', str(tmp_path / 'jinja_cache'))
+    monkeypatch.setattr(app, 'ensure_cancellation_resumer', lambda: None)
+
+    flask_app = app.create_app()
+    flask_app.testing = True
+    return flask_app
+
+def stub_database(monkeypatch, results):
+    monkeypatch.setattr(app, 'get_db_connection', lambda readonly=False: FakeConnection(results))
+
+
+def make_app(budget, queries):
+    flask_app = Flask(__name__)
+    flask_app.testing = True
+
+    @flask_app.before_request
+    def start_query_stats():
+        g.query_stats = app.QueryStats()
+
+    @flask_app.route('/view')
+    @app.query_budget(budget)
+    def view():
+        for i in range(queries):
+            app.record_query("SELECT * FROM events WHERE id = %s", (i,), 0.001, 1)
+        return 'ok'
+
+    return flask_app
+
+
+def test_repeated_flags_statement_run_with_varying_parameters(monkeypatch):
+    monkeypatch.setattr(app.Config, 'N_PLUS_ONE_THRESHOLD', 3)
+    stats = app.QueryStats()
+    for i in range(3):
+        stats.record("SELECT * FROM events WHERE id = %s", (i,), 0.001, 1)
+    stats.record("SELECT count(*) FROM users", None, 0.001, 1)
+
+    assert stats.count == 4
+    assert stats.rows == 4
+    assert stats.repeated() == [("SELECT * FROM events WHERE id = %s", 3)]
+
+
+def test_repeated_ignores_same_parameters_and_rare_statements(monkeypatch):
+    monkeypatch.setattr(app.Config, 'N_PLUS_ONE_THRESHOLD', 3)
+    stats = app.QueryStats()
+    for _ in range(5):
+        stats.record("SELECT * FROM events WHERE id = %s", (1,), 0.001, 1)
+    for i in range(2):
+        stats.record("SELECT * FROM users WHERE id = %s", (i,), 0.001, 1)
+
+    assert stats.repeated() == []
+
+
+def test_query_budget_strict_raises_when_over_budget(monkeypatch):
+    monkeypatch.setattr(app.Config, 'QUERY_BUDGET_STRICT', True)
+    client = make_app(budget=2, queries=3).test_client()
+
+    with pytest.raises(app.QueryBudgetExceeded, match="ran 3 queries, budget is 2"):
+        client.get('/view')
+
+
+def test_query_budget_strict_allows_within_budget(monkeypatch):
+    monkeypatch.setattr(app.Config, 'QUERY_BUDGET_STRICT', True)
+    client = make_app(budget=3, queries=3).test_client()
+
+    assert client.get('/view').data == b'ok'
+
+
+def test_query_budget_logs_when_not_strict(monkeypatch, capsys):
+    monkeypatch.setattr(app.Config, 'QUERY_BUDGET_STRICT', False)
+    client = make_app(budget=1, queries=2).test_client()
+
+    assert client.get('/view').data == b'ok'
+    assert "Query budget exceeded: view ran 2 queries, budget is 1" in capsys.readouterr().out
+
+
+def test_profiling_cursor_records_each_statement():
+    cursor = app.profiled_cursor_class(FakeCursor)([[(1,), (2,)], [(3,)]])
+
+    with Flask(__name__).test_request_context():
+        g.query_stats = app.QueryStats()
+        cursor.execute(b"SELECT id FROM events")
+        cursor.execute(sql.SQL("SELECT id FROM events WHERE id = {}").format(sql.Placeholder()), (3,))
+        cursor.executemany("UPDATE events SET version = version + 1 WHERE id = %s", [(1,), (2,)])
+        stats = g.query_stats
+
+    assert stats.count == 3
+    # executemany has no result set, so it returns no rows
+    assert stats.rows == 3
+    assert list(stats.statements) == [
+        "SELECT id FROM events",
+        "SELECT id FROM events WHERE id = %s",
+        "UPDATE events SET version = version + 1 WHERE id = %s",
+    ]
+    assert app.profiled_cursor_class(FakeCursor) is type(cursor)
+
+
+def test_events_route_reports_query_count(flask_app, monkeypatch):
+    stub_database(monkeypatch, [[]])
+
+    response = flask_app.test_client().get('/events')
+
+    assert response.status_code == 200
+    assert response.headers['X-Query-Count'] == '1'
+    assert response.headers['Server-Timing'].startswith('db;dur=')
+
+
+def test_user_dashboard_stays_within_query_budget(flask_app, monkeypatch):
+    user = {'id': 1, 'first_name': 'Jane', 'last_name': 'Doe', 'email': 'jane@example.com',
+            'phone': '123', 'version': 1}
+    stub_database(monkeypatch, [[user], [], []])
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['user_name'] = 'Jane Doe'
+
+    # QUERY_BUDGET_STRICT is on, so going over @query_budget would raise
+    response = client.get('/user_dashboard')
+
+    assert response.status_code == 200
+    assert response.headers['X-Query-Count'] == '3'
+
+
+def test_profiled_connection_with_real_database(monkeypatch):
+    monkeypatch.setattr(app.Config, 'QUERY_PROFILING', True)
+    try:
+        conn = app.connect_to(app.Config.DB_HOST, app.Config.DB_PORT)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no database: {e}")
+
+    try:
+        with Flask(__name__).test_request_context():
+            g.query_stats = app.QueryStats()
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT 1 AS one")
+                row = cur.fetchone()
+                cur.execute(sql.SQL("SELECT {} AS two").format(sql.Literal(2)))
+            stats = g.query_stats
+    finally:
+        conn.close()
+
+    assert isinstance(conn, app.ProfiledConnection)
+    assert row == {'one': 1}
+    assert stats.count == 2
+    assert list(stats.statements) == ["SELECT 1 AS one", "SELECT 2 AS two"]